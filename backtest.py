@@ -0,0 +1,351 @@
+"""Replay recorded prices, solar and load through SmartBatteryManager without Home Assistant.
+
+The real decision methods run against a simulated clock and an in-memory state store, a simple
+battery model turns the resulting script calls into energy flows, and parameter sweeps fan out
+over a process pool.
+"""
+import argparse
+import heapq
+import itertools
+import json
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from dateutil import parser
+
+import smart_battery
+from smart_battery import PriceSnapshot, SmartBatteryManager
+
+STEP = timedelta(minutes=15)
+
+
+class SimulatedClock:
+
+    def __init__(self, now: datetime) -> None:
+        self.now = now
+
+    @contextmanager
+    def patch(self) -> Iterator[None]:
+        # smart_battery reads the time through its module level datetime name
+        clock = self
+
+        class SimulatedDatetime(datetime):
+            @classmethod
+            def now(cls, tz=None):
+                return clock.now
+
+        original = smart_battery.datetime
+        smart_battery.datetime = SimulatedDatetime
+        try:
+            yield
+        finally:
+            smart_battery.datetime = original
+
+
+class StateStore:
+
+    def __init__(self, clock: SimulatedClock) -> None:
+        self.clock = clock
+        self.entities: Dict[str, Dict[str, Any]] = {}
+
+    def set(self, entity_id: str, state: Any, attributes: Optional[Dict[str, Any]] = None) -> None:
+        current = self.entities.get(entity_id)
+        attributes = attributes if attributes is not None else (current or {}).get("attributes", {})
+        if current is not None and current["state"] == state and current["attributes"] == attributes:
+            return
+        stamp = self.clock.now.isoformat()
+        self.entities[entity_id] = {
+            "entity_id": entity_id,
+            "state": state,
+            "attributes": attributes,
+            "last_changed": stamp if current is None or current["state"] != state else current["last_changed"],
+            "last_updated": stamp,
+        }
+
+    def get(self, entity_id: str, attribute: Optional[str] = None, default: Any = None) -> Any:
+        if "." not in entity_id:
+            # A whole domain, like get_state("sensor")
+            return {k: v for k, v in self.entities.items() if k.split(".", 1)[0] == entity_id}
+        entity = self.entities.get(entity_id)
+        if entity is None:
+            return default
+        if attribute is None:
+            return entity["state"]
+        if attribute == "all":
+            return entity
+        if attribute in entity["attributes"]:
+            return entity["attributes"][attribute]
+        return entity.get(attribute, default)
+
+
+class BatteryModel:
+
+    def __init__(self, capacity_kwh: float, soc: float) -> None:
+        self.capacity_kwh = capacity_kwh
+        self.soc = soc
+        self.charge_until: Optional[datetime] = None
+        self.charge_power_w = 0.0
+
+    def start_charge(self, now: datetime, duration_minutes: float, power_w: float) -> None:
+        self.charge_until = now + timedelta(minutes=duration_minutes)
+        self.charge_power_w = power_w
+
+    def stop_charge(self) -> None:
+        self.charge_until = None
+
+    def step(self, start: datetime, solar_kwh: float, load_kwh: float) -> Dict[str, float]:
+        # Solar covers the load first, the surplus goes to the battery and the rest of the load
+        # is taken from the battery before the grid. Forced charging comes from the grid.
+        stored = self.soc * self.capacity_kwh
+        charge_kwh = 0.0
+        if self.charge_until is not None and self.charge_until > start:
+            hours = (min(self.charge_until, start + STEP) - start).total_seconds() / 3600
+            charge_kwh = min(self.charge_power_w / 1000 * hours, self.capacity_kwh - stored)
+            stored += charge_kwh
+
+        net = solar_kwh - load_kwh
+        if net >= 0:
+            stored = min(stored + net, self.capacity_kwh)
+            import_kwh = 0.0
+        else:
+            from_battery = min(-net, stored)
+            stored -= from_battery
+            import_kwh = -net - from_battery
+
+        self.soc = stored / self.capacity_kwh
+        return {"charge_kwh": charge_kwh, "import_kwh": import_kwh + charge_kwh}
+
+
+class ReplayApp(SmartBatteryManager):
+    # Stand-ins for the AppDaemon API, backed by the simulated clock and state store
+
+    def __init__(self, args: Dict[str, Any], clock: SimulatedClock, store: StateStore, battery: BatteryModel) -> None:
+        # hass.Hass.__init__ needs a running AppDaemon, so only the planner state is set up.
+        # Nobody reads the plan and planner sensors during a replay, they are off unless configured.
+        self.name = "smart_battery_replay"
+        self.args = {"plan_sensor": "", "planner_sensor": "", **args}
+        self.clock = clock
+        self.store = store
+        self.battery = battery
+        self.timers: List[tuple] = []
+        self.cancelled: set = set()
+        self.handles = itertools.count()
+        self.service_calls = 0
+        self.init_planner_state()
+
+    def log(self, msg: str, *args: Any, **kwargs: Any) -> None:
+        pass
+
+    def get_state(self, entity_id: Optional[str] = None, attribute: Optional[str] = None, default: Any = None,
+                  copy: bool = True, **kwargs: Any) -> Any:
+        self._stats.count("get_state")
+        return self.store.get(entity_id, attribute, default)
+
+    def set_state(self, entity_id: str, **kwargs: Any) -> None:
+        self.store.set(entity_id, kwargs.get("state"), kwargs.get("attributes"))
+
+    def listen_state(self, callback: Callable, entity_id: Optional[str] = None, **kwargs: Any) -> None:
+        # The replay drives planning from the 15 minute tick only
+        return None
+
+    def run_at(self, callback: Callable, start: datetime, **kwargs: Any) -> str:
+        sequence = next(self.handles)
+        handle = f"timer-{sequence}"
+        heapq.heappush(self.timers, (start, sequence, handle, callback, kwargs))
+        return handle
+
+    def run_in(self, callback: Callable, delay: float, **kwargs: Any) -> str:
+        return self.run_at(callback, self.clock.now + timedelta(seconds=delay), **kwargs)
+
+    def cancel_timer(self, handle: str, silent: bool = False) -> bool:
+        self.cancelled.add(handle)
+        return True
+
+    def fire_timers(self) -> None:
+        while self.timers and self.timers[0][0] <= self.clock.now:
+            _, _, handle, callback, kwargs = heapq.heappop(self.timers)
+            if handle in self.cancelled:
+                self.cancelled.discard(handle)
+                continue
+            callback(kwargs)
+
+    def call_service(self, service: str, **kwargs: Any) -> None:
+        self.service_calls += 1
+        entity_id = kwargs.get("entity_id")
+        if entity_id == self.args.get("charge_stop_script"):
+            self.battery.stop_charge()
+        elif service == "script/turn_on":
+            variables = kwargs.get("variables", {})
+            self.battery.start_charge(self.clock.now, variables["duration"], variables["power"])
+
+
+class Dataset:
+
+    def __init__(self, start: datetime, prices: List[Dict[str, Any]], solar_kwh: List[float],
+                 load_kwh: Optional[List[float]] = None, initial_soc: float = 0.5) -> None:
+        # solar_kwh and load_kwh are per 15 minute step from start, prices are Tibber entries
+        self.start = start
+        self.prices = sorted(prices, key=lambda e: e["startsAt"])
+        self.solar_kwh = list(solar_kwh)
+        self.load_kwh = list(load_kwh) if load_kwh is not None else [0.0] * len(self.solar_kwh)
+        self.initial_soc = initial_soc
+        self.prices_by_day: Dict[Any, List[Dict[str, Any]]] = {}
+        for entry in self.prices:
+            day = parser.isoparse(entry["startsAt"]).date()
+            self.prices_by_day.setdefault(day, []).append(entry)
+
+    @classmethod
+    def from_json(cls, path: str) -> "Dataset":
+        with open(path) as f:
+            data = json.load(f)
+        soc = data.get("soc")
+        return cls(
+            parser.isoparse(data["start"]).replace(tzinfo=None),
+            data["prices"],
+            data["solar_kwh"],
+            data.get("load_kwh"),
+            float(soc[0]) / 100 if soc else data.get("initial_soc", 0.5),
+        )
+
+    def __len__(self) -> int:
+        return len(self.solar_kwh)
+
+
+def publish_inputs(store: StateStore, args: Dict[str, Any], solar_arrays: List[Dict[str, str]], dataset: Dataset,
+                   step: int, start: datetime, battery: BatteryModel, prices_published_hour: int) -> None:
+    now = store.clock.now
+    store.set(args["soc_sensor"], f"{battery.soc * 100:.1f}")
+
+    tomorrow = now.date() + timedelta(days=1)
+    store.set(args["tibber_sensor"], "ok", {
+        "today": dataset.prices_by_day.get(now.date(), []),
+        "tomorrow": dataset.prices_by_day.get(tomorrow, []) if now.hour >= prices_published_hour else [],
+    })
+
+    # The recorded production doubles as the forecast, reported on the first solar array
+    steps_left_today = (datetime.combine(start.date() + timedelta(days=1), datetime.min.time()) - start) // STEP
+    next_hour = sum(dataset.solar_kwh[step:step + 4])
+    remaining = sum(dataset.solar_kwh[step:step + steps_left_today])
+    for i, solar_array in enumerate(solar_arrays):
+        for key, value in (("energy_next_hour", next_hour), ("energy_today_remaining", remaining)):
+            if solar_array.get(key):
+                store.set(solar_array[key], f"{value if i == 0 else 0.0:.3f}")
+
+
+def run_backtest(dataset: Dataset, args: Dict[str, Any], prices_published_hour: int = 13) -> Dict[str, Any]:
+    args = {
+        "soc_sensor": "sensor.battery_soc",
+        "tibber_sensor": "sensor.tibber_prices",
+        "energy_next_hour_sensor_1": "sensor.energy_next_hour",
+        "energy_next_hour_sensor_2": "sensor.energy_next_hour_2",
+        "energy_today_remaining_sensor_1": "sensor.energy_today_remaining",
+        "energy_today_remaining_sensor_2": "sensor.energy_today_remaining_2",
+        **args,
+    }
+    clock = SimulatedClock(dataset.start)
+    store = StateStore(clock)
+    battery = BatteryModel(args.get("battery_capacity_kwh", 10), dataset.initial_soc)
+    app = ReplayApp(args, clock, store, battery)
+    # The same arrays the app reads, from solar_arrays or the older energy_*_sensor_1/_2 arguments
+    solar_arrays = app.get_solar_arrays()
+    prices = PriceSnapshot(None, dataset.prices)
+
+    cost = grid_kwh = charge_kwh = 0.0
+    target_misses = 0
+    price = 0.0
+    with clock.patch():
+        for step in range(len(dataset)):
+            start = dataset.start + step * STEP
+
+            # Plan one minute before the interval starts, like the HH:14/29/44/59 tick
+            clock.now = start - timedelta(minutes=1)
+            publish_inputs(store, args, solar_arrays, dataset, step, start, battery, prices_published_hour)
+            app.plan_charging({})
+
+            clock.now = start
+            app.fire_timers()
+
+            # Hourly or quarter hour targets, looked up the same way the planner does
+            target = app.get_target_soc_profile([start])[0]
+            if battery.soc < target - 1e-9:
+                target_misses += 1
+
+            slot_price = prices.price_at(start)
+            price = slot_price if slot_price is not None else price
+            flows = battery.step(start, dataset.solar_kwh[step], dataset.load_kwh[step])
+            cost += flows["import_kwh"] * price
+            grid_kwh += flows["import_kwh"]
+            charge_kwh += flows["charge_kwh"]
+
+    return {
+        "days": len(dataset) / 96,
+        "cost": cost,
+        "grid_kwh": grid_kwh,
+        "charge_kwh": charge_kwh,
+        "target_misses": target_misses,
+        "service_calls": app.service_calls,
+        "final_soc": battery.soc,
+    }
+
+
+_worker_dataset: Optional[Dataset] = None
+
+
+def _init_worker(dataset: Dataset) -> None:
+    global _worker_dataset
+    _worker_dataset = dataset
+
+
+def _run_worker(args: Dict[str, Any]) -> Dict[str, Any]:
+    return {"args": args, **run_backtest(_worker_dataset, args)}
+
+
+def param_grid(base_args: Dict[str, Any], **options: List[Any]) -> List[Dict[str, Any]]:
+    keys = list(options)
+    return [{**base_args, **dict(zip(keys, values))} for values in itertools.product(*(options[k] for k in keys))]
+
+
+def run_sweep(dataset: Dataset, configs: List[Dict[str, Any]], processes: Optional[int] = None) -> List[Dict[str, Any]]:
+    # The dataset is sent to each worker once, only the configurations travel per task
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(dataset,)) as pool:
+        chunksize = max(1, len(configs) // ((processes or 4) * 8))
+        return list(pool.map(_run_worker, configs, chunksize=chunksize))
+
+
+def main() -> None:
+    parser_ = argparse.ArgumentParser(description="Replay recorded data through the smart battery planner")
+    parser_.add_argument("dataset", help="JSON file with start, prices, solar_kwh and optionally load_kwh and soc")
+    parser_.add_argument("--config", help="apps.yaml to take the smart_battery arguments from")
+    parser_.add_argument("--grid", action="append", default=[], metavar="KEY=V1,V2",
+                         help="sweep a numeric argument over the given values, can be repeated")
+    parser_.add_argument("--processes", type=int)
+    parser_.add_argument("--top", type=int, default=10)
+    options = parser_.parse_args()
+
+    base_args: Dict[str, Any] = {}
+    if options.config:
+        import yaml
+        with open(options.config) as f:
+            base_args = next(iter(yaml.safe_load(f).values()))
+
+    grid = {}
+    for item in options.grid:
+        key, values = item.split("=", 1)
+        grid[key] = [json.loads(v) for v in values.split(",")]
+
+    dataset = Dataset.from_json(options.dataset)
+    configs = param_grid(base_args, **grid)
+    results = run_sweep(dataset, configs, options.processes) if len(configs) > 1 else [
+        {"args": configs[0], **run_backtest(dataset, configs[0])}
+    ]
+    results.sort(key=lambda r: r["cost"])
+    for result in results[:options.top]:
+        swept = {k: result["args"][k] for k in grid}
+        print(f"cost={result['cost']:.2f} grid={result['grid_kwh']:.1f}kWh charged={result['charge_kwh']:.1f}kWh "
+              f"misses={result['target_misses']} calls={result['service_calls']} {swept}")
+
+
+if __name__ == "__main__":
+    main()
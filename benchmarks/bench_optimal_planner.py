@@ -0,0 +1,40 @@
+import argparse
+import time
+
+import numpy as np
+
+from smart_battery import optimal_charge_mask
+
+
+def synthetic_horizon(slots: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    hours = np.arange(slots) * 24 / 96
+    prices = 1.0 + 0.6 * np.sin(2 * np.pi * (hours - 8) / 24) + rng.normal(0, 0.15, slots)
+    solar = np.clip(np.sin(np.pi * ((hours % 24) - 6) / 12), 0, None) * 0.8
+    targets = np.where((hours % 24 >= 7) & (hours % 24 < 18), 1.0, 0.3)
+    return prices, targets, solar
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Solve time of the optimal (DP) charge planner")
+    parser.add_argument("--slots", type=int, default=192)
+    parser.add_argument("--soc-steps", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    prices, targets, solar = synthetic_horizon(args.slots)
+    optimal_charge_mask(prices, targets, solar, 0.3, 10, 0.75, soc_steps=args.soc_steps)
+
+    timings = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        mask = optimal_charge_mask(prices, targets, solar, 0.3, 10, 0.75, soc_steps=args.soc_steps)
+        timings.append(time.perf_counter() - start)
+
+    timings.sort()
+    print(f"slots={args.slots} soc_steps={args.soc_steps} charge_slots={int(mask.sum())}")
+    print(f"best={timings[0] * 1000:.2f} ms median={timings[len(timings) // 2] * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+import argparse
+import json
+import os
+import statistics
+import time
+import tracemalloc
+from datetime import timedelta
+from typing import Any, Callable, Dict, List, Optional
+
+from backtest import BatteryModel, Dataset, ReplayApp, SimulatedClock, StateStore, run_backtest
+from benchmarks.synthetic import HORIZONS, SHAPES, START, tibber_attributes, tibber_entries
+
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), "baseline.json")
+REGRESSION_RATIO = 1.25
+
+ARGS = {
+    "soc_sensor": "sensor.battery_soc",
+    "tibber_sensor": "sensor.tibber_prices",
+    "energy_next_hour_sensor_1": "sensor.energy_next_hour",
+    "energy_next_hour_sensor_2": "sensor.energy_next_hour_2",
+    "energy_today_remaining_sensor_1": "sensor.energy_today_remaining",
+    "energy_today_remaining_sensor_2": "sensor.energy_today_remaining_2",
+    "battery_capacity_kwh": 10,
+    "always_charge_factor": 0.1,
+    "soc_targets": [0.3] * 3 + [0.5] * 4 + [1.0] * 11 + [0.5] * 3 + [0.3] * 3,
+}
+
+
+class BenchApp(ReplayApp):
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.get_state_calls = 0
+
+    def get_state(self, *args: Any, **kwargs: Any) -> Any:
+        self.get_state_calls += 1
+        return super().get_state(*args, **kwargs)
+
+    def set_state(self, entity_id: str, **kwargs: Any) -> None:
+        # Keep the planner sensor out of the measured state store
+        pass
+
+
+def make_app(horizon: str, shape: str) -> BenchApp:
+    slots, minutes = HORIZONS[horizon]
+    clock = SimulatedClock(START + timedelta(hours=1, minutes=59))
+    store = StateStore(clock)
+    store.set(ARGS["soc_sensor"], "40")
+    store.set(ARGS["tibber_sensor"], "ok", tibber_attributes(tibber_entries(slots, minutes, shape)))
+    store.set(ARGS["energy_next_hour_sensor_1"], "0.4")
+    store.set(ARGS["energy_next_hour_sensor_2"], "0.2")
+    store.set(ARGS["energy_today_remaining_sensor_1"], "3.0")
+    store.set(ARGS["energy_today_remaining_sensor_2"], "1.5")
+    # The planning cases publish the plan and planner sensors like the app does in Home Assistant
+    args = {**ARGS, "plan_sensor": "sensor.smart_battery_plan", "planner_sensor": "sensor.smart_battery_planner"}
+    return BenchApp(args, clock, store, BatteryModel(10, 0.4))
+
+
+def cases(app: BenchApp) -> Dict[str, tuple]:
+    # name -> (setup, call). The setup resets whatever the call would otherwise find cached.
+    all_prices = app.get_all_prices()
+    minima = app.find_local_minima(all_prices)
+    next_interval = app.clock.now.replace(second=0, microsecond=0) + timedelta(minutes=1)
+    # Backtest throughput: one day of 15 minute ticks over the same prices
+    prices = app.store.get(ARGS["tibber_sensor"], attribute="today") + app.store.get(ARGS["tibber_sensor"], attribute="tomorrow")
+    day = Dataset(START, prices, [0.0] * 96, [0.1] * 96, initial_soc=0.4)
+
+    def cold() -> None:
+        app.init_planner_state()
+        app._price_snapshot = None
+        app._plan_key = None
+
+    def warm() -> None:
+        app._plan_key = None
+
+    def uncached_candidates() -> None:
+        # Keep the parsed prices, but smooth and expand the candidates from scratch
+        app.get_price_snapshot().candidates = None
+        app._smoother = None
+
+    return {
+        "plan_charging[cold]": (cold, lambda: app.plan_charging({})),
+        "plan_charging[warm]": (warm, lambda: app.plan_charging({})),
+        "get_all_prices[cold]": (cold, app.get_all_prices),
+        "get_candidate_hours[cold]": (uncached_candidates, app.get_candidate_hours),
+        # The planner no longer calls these two, they stay to compare with older baselines
+        "find_local_minima": (None, lambda: app.find_local_minima(all_prices)),
+        "build_candidate_hours": (None, lambda: app.build_candidate_hours(minima, all_prices)),
+        "get_price_for_interval": (None, lambda: app.get_price_for_interval(next_interval)),
+        "check_skip_charge": (None, lambda: app.check_skip_charge(0.4, 0.8, 4.0)),
+        "run_backtest[day]": (None, lambda: run_backtest(day, ARGS)),
+    }
+
+
+def measure(app: BenchApp, setup: Optional[Callable], call: Callable, repeat: int) -> Dict[str, float]:
+    timings = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        call()
+        timings.append(time.perf_counter() - start)
+
+    if setup:
+        setup()
+    app.get_state_calls = 0
+    tracemalloc.start()
+    call()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "median_us": statistics.median(timings) * 1e6,
+        "min_us": min(timings) * 1e6,
+        "peak_kib": peak / 1024,
+        "get_state_calls": app.get_state_calls,
+    }
+
+
+def run(repeat: int, only: Optional[str] = None) -> Dict[str, Dict[str, float]]:
+    results = {}
+    for horizon in HORIZONS:
+        for shape in SHAPES:
+            app = make_app(horizon, shape)
+            with app.clock.patch():
+                for name, (setup, call) in cases(app).items():
+                    key = f"{name}/{horizon}/{shape}"
+                    if only and only not in key:
+                        continue
+                    results[key] = measure(app, setup, call, repeat)
+    return results
+
+
+def report(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]]) -> List[str]:
+    regressions = []
+    print(f"{'benchmark':<45} {'median':>11} {'min':>11} {'peak':>10} {'get_state':>9} {'vs base':>8}")
+    for key, r in results.items():
+        base = baseline.get(key)
+        ratio = r["median_us"] / base["median_us"] if base and base["median_us"] else None
+        flag = ""
+        if ratio is not None and ratio > REGRESSION_RATIO:
+            flag = " !"
+            regressions.append(key)
+        print(f"{key:<45} {r['median_us']:>9.1f}us {r['min_us']:>9.1f}us {r['peak_kib']:>7.1f}KiB "
+              f"{r['get_state_calls']:>9} {f'{ratio:.2f}x' if ratio else '-':>8}{flag}")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmarks for the planning hot path")
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("-k", dest="only", help="only run benchmarks whose name contains this string")
+    parser.add_argument("--save-baseline", action="store_true", help=f"store the results in {BASELINE_FILE}")
+    options = parser.parse_args()
+
+    results = run(options.repeat, options.only)
+    baseline = {}
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE) as f:
+            baseline = json.load(f)
+
+    regressions = report(results, baseline)
+    if options.save_baseline:
+        with open(BASELINE_FILE, "w") as f:
+            json.dump({**baseline, **results}, f, indent=2, sort_keys=True)
+        print(f"Baseline saved to {BASELINE_FILE}")
+    elif regressions:
+        print(f"{len(regressions)} benchmark(s) more than {REGRESSION_RATIO:.2f}x slower than the baseline")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
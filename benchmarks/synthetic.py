@@ -0,0 +1,40 @@
+import math
+import random
+from datetime import datetime, timedelta
+from typing import Any, Dict, List
+
+START = datetime(2025, 5, 1)
+
+# name -> (slots, slot length in minutes)
+HORIZONS = {
+    "24": (24, 60),
+    "48": (48, 60),
+    "192": (192, 15),
+    "2016": (2016, 15),
+}
+
+SHAPES = ("volatile", "flat")
+
+
+def tibber_entries(slots: int, minutes: int, shape: str, seed: int = 0) -> List[Dict[str, Any]]:
+    # Deterministic Tibber price entries: a daily curve with large noise, or an almost flat price
+    rng = random.Random(f"{slots}-{minutes}-{shape}-{seed}")
+    entries = []
+    for i in range(slots):
+        start = START + timedelta(minutes=minutes * i)
+        hour = start.hour + start.minute / 60
+        if shape == "volatile":
+            price = 1.0 + 0.6 * math.sin(2 * math.pi * (hour - 8) / 24) + rng.uniform(-0.4, 0.4)
+        else:
+            price = 1.0 + rng.uniform(-0.005, 0.005)
+        entries.append({"startsAt": start.isoformat() + "+02:00", "total": round(price, 4)})
+    return entries
+
+
+def tibber_attributes(entries: List[Dict[str, Any]]) -> Dict[str, Any]:
+    # Everything on the first day is "today", the rest is "tomorrow"
+    first_day = entries[0]["startsAt"][:10]
+    return {
+        "today": [e for e in entries if e["startsAt"][:10] == first_day],
+        "tomorrow": [e for e in entries if e["startsAt"][:10] != first_day],
+    }
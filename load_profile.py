@@ -0,0 +1,102 @@
+"""Expected household consumption per weekday and hour from the Home Assistant recorder.
+
+Hourly long-term statistics of one energy (kWh, has a sum) or power (W, has a mean) statistic are
+read straight from the recorder SQLite database in read-only mode. Each run only reads the rows
+written since the last one and folds them into a per-weekday, per-hour moving average.
+"""
+import sqlite3
+import time
+from contextlib import closing
+from datetime import datetime, timedelta
+from typing import List, Optional, Union
+
+import numpy as np
+
+HOUR = 3600
+
+
+class LoadProfile:
+
+    def __init__(self, db_path: str, statistic_id: str, history_days: int = 28, smoothing: float = 0.25,
+                 check_interval: float = 300) -> None:
+        self.db_path = db_path
+        self.statistic_id = statistic_id
+        self.history_days = history_days
+        # Weight of a new hour in its weekday/hour average, one sample per cell per week
+        self.smoothing = smoothing
+        self.kwh = np.full((7, 24), np.nan)
+        self.last_start_ts: Optional[float] = None
+        self.last_sum: Optional[float] = None
+        self.metadata: Optional[tuple] = None
+        # Planning runs every 15 minutes or on input changes, the database is looked at most this often
+        self.check_interval = check_interval
+        self.last_checked: Optional[float] = None
+
+    def connect(self) -> sqlite3.Connection:
+        # Read-only, the recorder keeps writing to the database while we read
+        return sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, timeout=5)
+
+    def update(self, now: Optional[float] = None) -> int:
+        now = time.time() if now is None else now
+        # A statistics row for an hour is only written after that hour has ended
+        if self.last_start_ts is not None and now < self.last_start_ts + 2 * HOUR:
+            return 0
+        if self.last_checked is not None and now < self.last_checked + self.check_interval:
+            return 0
+        self.last_checked = now
+
+        since = self.last_start_ts if self.last_start_ts is not None else now - self.history_days * 24 * HOUR
+        rows = 0
+        with closing(self.connect()) as connection:
+            if self.metadata is None:
+                self.metadata = connection.execute(
+                    "SELECT id, has_sum FROM statistics_meta WHERE statistic_id = ?", (self.statistic_id,)
+                ).fetchone()
+                if self.metadata is None:
+                    raise ValueError(f"No statistics found for {self.statistic_id}")
+            metadata_id, has_sum = self.metadata
+            cursor = connection.execute(
+                "SELECT start_ts, mean, sum FROM statistics WHERE metadata_id = ? AND start_ts > ? ORDER BY start_ts",
+                (metadata_id, since),
+            )
+            for start_ts, mean, total in cursor:
+                rows += 1
+                self.add(start_ts, mean, total, bool(has_sum))
+        return rows
+
+    def add(self, start_ts: float, mean: Optional[float], total: Optional[float], has_sum: bool) -> None:
+        if has_sum:
+            previous, self.last_sum = self.last_sum, total
+            # The first row only gives the starting point of the sum, a drop means the meter was reset
+            kwh = None if previous is None or total is None or total < previous else total - previous
+        else:
+            kwh = None if mean is None else mean / 1000
+        self.last_start_ts = start_ts
+        if kwh is None:
+            return
+        start = datetime.fromtimestamp(start_ts)
+        cell = (start.weekday(), start.hour)
+        current = self.kwh[cell]
+        self.kwh[cell] = kwh if np.isnan(current) else current + self.smoothing * (kwh - current)
+
+    def hourly_kwh(self, when: datetime) -> float:
+        value = self.kwh[when.weekday(), when.hour]
+        if np.isnan(value):
+            # Hours without history use the average of all hours that have one
+            known = self.kwh[~np.isnan(self.kwh)]
+            return float(known.mean()) if len(known) else 0.0
+        return float(value)
+
+    def slot_energy(self, times: List[datetime], interval: Union[timedelta, np.ndarray]) -> np.ndarray:
+        # One length for all slots, or the length of every slot in seconds
+        seconds = interval.total_seconds() if isinstance(interval, timedelta) else np.asarray(interval, dtype=float)
+        return np.array([self.hourly_kwh(t) for t in times], dtype=float) * seconds / HOUR
+
+    def energy_between(self, start: datetime, end: datetime) -> float:
+        energy = 0.0
+        t = start
+        while t < end:
+            hour_end = min(t.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1), end)
+            energy += self.hourly_kwh(t) * (hour_end - t).total_seconds() / HOUR
+            t = hour_end
+        return energy
@@ -1,12 +1,682 @@
-import appdaemon.plugins.hass.hassapi as hass
+import asyncio
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from typing import Optional, List, Dict, Any
+from types import MappingProxyType
+from typing import Optional, List, Dict, Any, Iterator, Mapping, Union
+
+import appdaemon.plugins.hass.hassapi as hass
+import numpy as np
 from dateutil import parser
+from numpy.lib.stride_tricks import sliding_window_view
+
+from load_profile import LoadProfile
+
+
+def local_minima_mask(prices: np.ndarray) -> np.ndarray:
+    mask = np.zeros(len(prices), dtype=bool)
+    if len(prices) >= 3:
+        inner = prices[1:-1]
+        mask[1:-1] = (inner < prices[:-2]) & (inner < prices[2:])
+    return mask
+
+
+def _run_ends(values: np.ndarray, starts: np.ndarray, thresholds: np.ndarray) -> np.ndarray:
+    # For every start index, the last index of the contiguous run after it where values <= threshold.
+    # Uses a sparse table of range maxima and binary lifting, so all starts are resolved together.
+    n = len(values)
+    table = [values]
+    while (1 << len(table)) <= n:
+        prev, half = table[-1], 1 << (len(table) - 1)
+        table.append(np.maximum(prev[:-half], prev[half:]))
+
+    ends = starts.copy()
+    for level in range(len(table) - 1, -1, -1):
+        block = table[level]
+        nxt = ends + 1
+        fits = nxt + (1 << level) <= n
+        ok = np.zeros(len(ends), dtype=bool)
+        ok[fits] = block[nxt[fits]] <= thresholds[fits]
+        ends[ok] += 1 << level
+    return ends
+
+
+def candidate_mask(prices: np.ndarray, minima: Optional[np.ndarray] = None, tolerance: float = 0.10) -> np.ndarray:
+    n = len(prices)
+    if n == 0:
+        return np.zeros(0, dtype=bool)
+    if minima is None:
+        minima = local_minima_mask(prices)
+    minima_idx = np.flatnonzero(minima)
+    if len(minima_idx) == 0:
+        return np.zeros(n, dtype=bool)
+
+    # Slots at or above the mean can never extend a run
+    mean_price = prices.mean()
+    eligible = np.where(prices < mean_price, prices, np.inf)
+    thresholds = prices[minima_idx] + tolerance
+
+    right = _run_ends(eligible, minima_idx, thresholds)
+    left = n - 1 - _run_ends(eligible[::-1].copy(), n - 1 - minima_idx, thresholds)
+
+    # Mark every [left, right] range with a difference array
+    coverage = np.zeros(n + 1, dtype=np.int64)
+    np.add.at(coverage, left, 1)
+    np.add.at(coverage, right + 1, -1)
+    return np.cumsum(coverage[:n]) > 0
+
+
+def smooth_prices(prices: np.ndarray, window: int, method: str = "mean", start: int = 0, stop: Optional[int] = None) -> np.ndarray:
+    # Centered moving mean or median over `window` slots for slots [start, stop) of the series,
+    # the series is padded with its first and last price so the edges are smoothed as well
+    n = len(prices)
+    stop = n if stop is None else stop
+    if window <= 1 or start >= stop:
+        return prices[start:stop].astype(float)
+    half = window // 2
+    lo = max(start - half, 0)
+    hi = min(stop + window - 1 - half, n)
+    padded = np.pad(prices[lo:hi], (half - (start - lo), window - 1 - half - (hi - stop)), mode="edge")
+    if method == "median":
+        return np.median(sliding_window_view(padded, window), axis=1)
+    sums = np.concatenate(([0.0], np.cumsum(padded)))
+    return (sums[window:] - sums[:-window]) / window
+
+
+def ema_prices(prices: np.ndarray, window: int, previous: Optional[float] = None) -> np.ndarray:
+    # Exponential moving average with the span of `window` slots, continuing from `previous` if given
+    alpha = 2 / (window + 1)
+    smoothed = np.empty(len(prices))
+    value = previous
+    for i, price in enumerate(prices.tolist()):
+        value = price if value is None else value + alpha * (price - value)
+        smoothed[i] = value
+    return smoothed
+
+
+def optimal_charge_mask(
+    prices: np.ndarray,
+    targets: np.ndarray,
+    solar_kwh: np.ndarray,
+    soc: float,
+    capacity_kwh: float,
+    charge_kwh: Union[float, np.ndarray],
+    soc_steps: int = 1000,
+    shortfall_penalty: Optional[float] = None,
+    load_kwh: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    # Dynamic program over a discretized SoC grid. Each slot either idles or charges at full power,
+    # solar net of the expected load is applied first, and missing the SoC target at the end of a slot
+    # costs shortfall_penalty per kWh so the problem always stays feasible.
+    n = len(prices)
+    if n == 0:
+        return np.zeros(0, dtype=bool)
+    if shortfall_penalty is None:
+        shortfall_penalty = 10 * (float(np.abs(prices).max()) + 1)
+
+    kwh_per_step = capacity_kwh / soc_steps
+    states = np.arange(soc_steps + 1)
+    net_kwh = np.asarray(solar_kwh) - (np.asarray(load_kwh) if load_kwh is not None else 0.0)
+    solar_steps = np.rint(net_kwh / kwh_per_step).astype(np.int64)
+    # charge_kwh is one amount for all slots or the amount of every slot
+    charge_steps = np.rint(np.broadcast_to(np.asarray(charge_kwh, dtype=float), (n,)) / kwh_per_step).astype(np.int64)
+    target_steps = np.ceil(np.asarray(targets) * soc_steps - 1e-9).astype(np.int64)
+
+    value = np.zeros(soc_steps + 1)
+    decisions = np.zeros((n, soc_steps + 1), dtype=bool)
+    for i in range(n - 1, -1, -1):
+        idle_next = np.clip(states + solar_steps[i], 0, soc_steps)
+        charge_next = np.minimum(idle_next + charge_steps[i], soc_steps)
+        idle_cost = np.maximum(target_steps[i] - idle_next, 0) * kwh_per_step * shortfall_penalty + value[idle_next]
+        charge_cost = (
+            (charge_next - idle_next) * kwh_per_step * prices[i]
+            + np.maximum(target_steps[i] - charge_next, 0) * kwh_per_step * shortfall_penalty
+            + value[charge_next]
+        )
+        decisions[i] = charge_cost < idle_cost
+        value = np.where(decisions[i], charge_cost, idle_cost)
+
+    mask = np.zeros(n, dtype=bool)
+    state = min(max(int(round(soc * soc_steps)), 0), soc_steps)
+    for i in range(n):
+        mask[i] = decisions[i, state]
+        state = min(max(state + solar_steps[i], 0) + (charge_steps[i] if mask[i] else 0), soc_steps)
+    return mask
+
+
+def project_soc(
+    candidates: np.ndarray,
+    targets: np.ndarray,
+    solar_kwh: np.ndarray,
+    soc: float,
+    capacity_kwh: float,
+    charge_kwh: Union[float, np.ndarray],
+    load_kwh: Optional[np.ndarray] = None,
+) -> tuple:
+    # Walk the horizon charging in candidate slots until the target is reached.
+    # Returns the slots that charge and the SoC at the end of every slot.
+    n = len(candidates)
+    charge = np.zeros(n, dtype=bool)
+    projected = np.zeros(n)
+    charge_kwh = np.broadcast_to(np.asarray(charge_kwh, dtype=float), (n,))
+    level = soc
+    for i in range(n):
+        charge[i] = candidates[i] and level < targets[i]
+        net_kwh = solar_kwh[i] - (load_kwh[i] if load_kwh is not None else 0.0)
+        level = min(1.0, max(level + net_kwh / capacity_kwh, 0.0) + (charge_kwh[i] if charge[i] else 0.0) / capacity_kwh)
+        projected[i] = level
+    return charge, projected
+
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def _seconds(t: datetime) -> float:
+    return (t - _EPOCH).total_seconds()
+
+
+def _utc_seconds(t: datetime) -> float:
+    # Timestamps without an offset are taken as they are
+    return t.timestamp() if t.tzinfo is not None else _seconds(t)
+
+
+def slot_start(when: datetime, interval: timedelta) -> datetime:
+    # Start of the slot containing a local time, slots of up to an hour are aligned to the clock
+    minutes = min(max(int(interval.total_seconds() // 60), 1), 60)
+    return when.replace(minute=when.minute - when.minute % minutes, second=0, microsecond=0)
+
+
+def solar_forecast_periods(attributes: Mapping[str, Any]) -> Optional[tuple]:
+    # Forecast.Solar style profiles keyed by period start: energy in Wh (wh_period) or average power in W (watts).
+    # Returns the UTC start and end of every period in seconds and its energy in kWh.
+    values = attributes.get("wh_period")
+    watts = not values
+    if watts:
+        values = attributes.get("watts")
+    if not values:
+        return None
+    points = sorted(
+        (_utc_seconds(parser.isoparse(t) if isinstance(t, str) else t), float(v))
+        for t, v in values.items()
+    )
+    starts = np.array([t for t, _ in points])
+    values = np.array([v for _, v in points])
+
+    # A period lasts until the next one, but never longer than the profile's resolution (e.g. over night)
+    steps = np.diff(starts)
+    step = steps[steps > 0].min() if (steps > 0).any() else 3600.0
+    ends = np.minimum(np.append(starts[1:], starts[-1] + step), starts + step)
+    kwh = values / 1000 * ((ends - starts) / 3600 if watts else 1)
+    return starts, ends, kwh
+
+
+def align_energy(starts: np.ndarray, ends: np.ndarray, kwh: np.ndarray, slot_starts: np.ndarray, slot_ends: np.ndarray) -> np.ndarray:
+    # Interpolate the cumulative energy curve at the slot boundaries, energy is spread evenly within a period
+    x = np.column_stack((starts, ends)).ravel()
+    cumulative = np.cumsum(kwh)
+    y = np.column_stack((cumulative - kwh, cumulative)).ravel()
+    return np.interp(slot_ends, x, y) - np.interp(slot_starts, x, y)
+
+
+def parse_price_entries(entries: List[Dict[str, Any]]) -> List[tuple]:
+    return [(parser.isoparse(e["startsAt"]), float(e["total"])) for e in entries]
+
+
+class SlotSeries:
+    """Values on a grid of fixed-length slots. Slots are stored by their UTC start, so looking up
+    a local time is O(1) and stays correct when the clocks change."""
+
+    def __init__(self, starts: List[datetime], values: np.ndarray, interval: Optional[timedelta] = None) -> None:
+        # starts are sorted by UTC and carry their UTC offset. The grid has the smallest spacing of the entries,
+        # an hourly entry next to quarter hour ones covers the four grid slots of its hour.
+        self.utc = np.array([_utc_seconds(t) for t in starts], dtype=float)
+        self.values = values
+        # Local wall clock start of every slot, what timers and targets work with
+        self.times: List[datetime] = [t.replace(tzinfo=None) for t in starts]
+        offsets = np.array([_seconds(t.replace(tzinfo=None)) for t in starts]) - self.utc
+
+        # Slot length is the smallest spacing between entries, hourly if it cannot be derived
+        if interval is None:
+            steps = np.diff(self.utc)
+            interval = timedelta(seconds=float(steps[steps > 0].min())) if (steps > 0).any() else timedelta(hours=1)
+        self.interval = interval
+        self.step = interval.total_seconds()
+        # Length of every entry in seconds and its UTC end
+        self.durations = self.entry_durations()
+        self.ends = self.utc + self.durations
+
+        # position[k] is the entry in grid slot k, or -1 for a gap
+        self.start = float(self.utc[0]) if len(self.utc) else 0.0
+        counts = np.maximum(np.ceil(self.durations / self.step - 1e-9), 1).astype(np.int64)
+        first = ((self.utc - self.start) // self.step).astype(np.int64)
+        entry = np.repeat(np.arange(len(self.utc)), counts)
+        slots = np.repeat(first, counts) + np.arange(len(entry)) - np.repeat(np.cumsum(counts) - counts, counts)
+        size = int(slots.max()) + 1 if len(slots) else 0
+        self.position = np.full(size, -1, dtype=np.int64)
+        self.position[slots] = entry
+        # UTC offset in effect in every grid slot, carried over gaps
+        last_entry = np.maximum.accumulate(self.position) if size else self.position
+        self.grid_offsets = offsets[last_entry] if size else offsets
+        # Summer time first, so an ambiguous local time resolves to its first occurrence
+        self.offsets = sorted({float(o) for o in offsets}, reverse=True)
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    def entry_durations(self) -> np.ndarray:
+        # An entry lasts until the next one, but no longer than the spacing of the entries on its local day,
+        # so gaps stay gaps while a day of hourly prices next to a day of quarter hour prices keeps its length
+        n = len(self.utc)
+        if n == 0:
+            return np.zeros(0)
+        days = np.array([t.toordinal() for t in self.times])
+        gaps = np.diff(self.utc)
+        native = np.full(n, self.step)
+        same_day = (days[1:] == days[:-1]) & (gaps > 0)
+        for day in np.unique(days):
+            day_gaps = gaps[same_day & (days[:-1] == day)]
+            if len(day_gaps):
+                native[days == day] = day_gaps.min()
+        return np.minimum(np.append(gaps, np.inf), native)
+
+    def to_utc(self, when: datetime) -> float:
+        if when.utcoffset() is not None:
+            return _utc_seconds(when)
+        local = _seconds(when)
+        last = len(self.position) - 1
+        for offset in self.offsets:
+            k = min(max(int((local - offset - self.start) // self.step), 0), last)
+            if self.grid_offsets[k] == offset:
+                return local - offset
+        return local - (self.offsets[0] if self.offsets else 0.0)
+
+    def index(self, when: datetime) -> Optional[int]:
+        if not len(self.position):
+            return None
+        k = int((self.to_utc(when) - self.start) // self.step)
+        if 0 <= k < len(self.position) and self.position[k] >= 0:
+            return int(self.position[k])
+        return None
+
+    def searchsorted(self, when: datetime, side: str = "left") -> int:
+        return int(np.searchsorted(self.utc, self.to_utc(when), side=side))
+
+    def containing(self, when: datetime) -> int:
+        # The slot containing a time, or the first slot if it is before the series
+        return max(self.searchsorted(when, side="right") - 1, 0)
+
+
+class PriceSnapshot:
+    """Tibber prices parsed once per sensor update, on a slot series ordered by UTC start."""
+
+    def __init__(self, key: Optional[str], entries: List[Dict[str, Any]], parsed: Optional[List[tuple]] = None) -> None:
+        parsed = sorted(parse_price_entries(entries) if parsed is None else parsed, key=lambda e: _utc_seconds(e[0]))
+        self.key = key
+        self.parsed = parsed
+        self.series = SlotSeries(
+            [t for t, _ in parsed], np.fromiter((p for _, p in parsed), dtype=float, count=len(parsed))
+        )
+        self.times = self.series.times
+        self.prices = self.series.values
+        self.interval = self.series.interval
+
+        # suffix_sums[i] is the sum of all prices from slot i onwards
+        self.suffix_sums = np.zeros(len(self.prices) + 1)
+        self.suffix_sums[:-1] = np.cumsum(self.prices[::-1])[::-1]
+        self.mean = float(self.prices.mean()) if len(self.prices) else 0.0
+        self.candidates: Optional[List[datetime]] = None
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    def items(self) -> List[tuple]:
+        return list(zip(self.times, self.prices.tolist()))
+
+    def future_mean(self, now: datetime) -> Optional[float]:
+        start = self.series.searchsorted(now)
+        count = len(self.times) - start
+        if count == 0:
+            return None
+        return float(self.suffix_sums[start] / count)
+
+    def slot_index(self, when: datetime) -> Optional[int]:
+        return self.series.index(when)
+
+    def price_at(self, when: datetime) -> Optional[float]:
+        i = self.slot_index(when)
+        return None if i is None else float(self.prices[i])
+
+
+class PriceSmoother:
+    """Smoothed prices of the last series seen. A new series that overlaps it (tomorrow's prices
+    appended, or yesterday dropped) only recomputes the slots whose window changed."""
+
+    methods = ("mean", "median", "ema")
+
+    def __init__(self, method: str = "mean", window: int = 1) -> None:
+        if method not in self.methods:
+            raise ValueError(f"Unknown smoothing method {method}, use one of {', '.join(self.methods)}")
+        self.method = method
+        self.window = max(window, 1)
+        self.keys = np.zeros(0)
+        self.prices = np.zeros(0)
+        self.smoothed = np.zeros(0)
+        self.recomputed = 0
+
+    def update(self, keys: np.ndarray, prices: np.ndarray) -> np.ndarray:
+        n = len(prices)
+        offset, overlap = self.overlap(keys, prices)
+        if offset == 0 and overlap == n == len(self.prices):
+            self.recomputed = 0
+            return self.smoothed
+
+        smoothed = np.empty(n)
+        if self.method == "ema":
+            # The average only depends on earlier prices, so appended prices continue it. When the start of
+            # the series moved it is seeded again from the new first price, like a fresh computation.
+            reused = overlap if offset == 0 else 0
+            smoothed[:reused] = self.smoothed[:reused]
+            previous = float(smoothed[reused - 1]) if reused else None
+            smoothed[reused:] = ema_prices(prices[reused:], self.window, previous)
+            self.recomputed = n - reused
+        else:
+            # Slots within half a window of either end depend on the edge padding and are recomputed
+            half = self.window // 2
+            head = min(half if offset > 0 else 0, overlap)
+            tail = max(overlap - (self.window - 1 - half), head)
+            smoothed[head:tail] = self.smoothed[offset + head:offset + tail]
+            smoothed[:head] = smooth_prices(prices, self.window, self.method, 0, head)
+            smoothed[tail:] = smooth_prices(prices, self.window, self.method, tail, n)
+            self.recomputed = n - (tail - head)
+
+        self.keys, self.prices, self.smoothed = keys, prices, smoothed
+        return smoothed
+
+    def overlap(self, keys: np.ndarray, prices: np.ndarray) -> tuple:
+        # Where the new series starts in the previous one and for how many slots they agree
+        if not len(keys) or not len(self.keys):
+            return 0, 0
+        offset = int(np.searchsorted(self.keys, keys[0]))
+        if offset >= len(self.keys) or self.keys[offset] != keys[0]:
+            return 0, 0
+        count = min(len(self.keys) - offset, len(keys))
+        same = (self.keys[offset:offset + count] == keys[:count]) & (self.prices[offset:offset + count] == prices[:count])
+        overlap = count if same.all() else int(np.argmin(same))
+        return offset, overlap
+
+
+class SolarProfile:
+    """Forecast solar energy of all arrays per price slot, rebuilt when a forecast entity updates."""
+
+    def __init__(self, key: Any, series: SlotSeries, energy: np.ndarray) -> None:
+        self.key = key
+        self.series = series
+        self.times = series.times
+        # Energy per slot, at the same positions as the price slots
+        self.energy = energy
+        # Cumulative energy at the start and end of every slot
+        self.bounds = np.column_stack((series.utc, series.ends)).ravel()
+        cumulative = np.cumsum(energy)
+        self.cumulative = np.column_stack((cumulative - energy, cumulative)).ravel()
+
+    def energy_between(self, start: datetime, end: datetime) -> float:
+        if not self.times:
+            return 0.0
+        at_start, at_end = np.interp([self.series.to_utc(start), self.series.to_utc(end)], self.bounds, self.cumulative)
+        return float(at_end - at_start)
+
+
+class StateSnapshot:
+    """Read-only copy of the configured entities, taken once per planning run."""
+
+    def __init__(self, entities: Dict[str, Dict[str, Any]]) -> None:
+        self._entities: Mapping[str, Mapping[str, Any]] = MappingProxyType({
+            entity_id: MappingProxyType({**entity, "attributes": MappingProxyType(dict(entity.get("attributes") or {}))})
+            for entity_id, entity in entities.items()
+        })
+
+    def __contains__(self, entity_id: str) -> bool:
+        return entity_id in self._entities
+
+    def get(self, entity_id: str, attribute: Optional[str] = None) -> Any:
+        # Same lookup rules as AppDaemon's get_state for a single entity
+        entity = self._entities.get(entity_id)
+        if entity is None:
+            return None
+        if attribute is None:
+            return entity.get("state")
+        if attribute == "all":
+            return entity
+        if attribute in entity["attributes"]:
+            return entity["attributes"][attribute]
+        return entity.get(attribute)
+
+
+class HorizonPlan:
+    """Planned charge slots, projected SoC and expected solar from the current slot to the end of the prices."""
+
+    def __init__(
+        self,
+        key: Optional[str],
+        times: List[datetime],
+        durations: np.ndarray,
+        prices: np.ndarray,
+        candidates: np.ndarray,
+        charge: np.ndarray,
+        solar_kwh: np.ndarray,
+        projected_soc: np.ndarray,
+    ) -> None:
+        self.key = key
+        self.times = times
+        # Length of every slot in seconds, hourly and quarter hour slots can be mixed
+        self.durations = durations
+        self.prices = prices
+        self.candidates = candidates
+        self.charge = charge
+        self.solar_kwh = solar_kwh
+        self.projected_soc = projected_soc
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    @classmethod
+    def from_attributes(cls, key: Optional[str], snapshot: PriceSnapshot, attributes: Mapping[str, Any]) -> "HorizonPlan":
+        # The slot times come from the prices the plan was built on
+        start = snapshot.slot_index(parser.isoparse(attributes["start"]))
+        if start is None:
+            raise ValueError(f"Plan start {attributes['start']} is not a price slot")
+        stop = start + len(attributes["prices"])
+        times = snapshot.times[start:stop]
+        return cls(
+            key,
+            times,
+            snapshot.series.durations[start:stop],
+            np.array(attributes["prices"], dtype=float),
+            cls.windows_mask(times, attributes["candidate_windows"]),
+            cls.windows_mask(times, attributes["charge_windows"]),
+            np.array(attributes["solar_kwh"], dtype=float),
+            np.array(attributes["projected_soc"], dtype=float),
+        )
+
+    @staticmethod
+    def windows_mask(times: List[datetime], windows: List[List[str]]) -> np.ndarray:
+        bounds = [(parser.isoparse(start), parser.isoparse(end)) for start, end in windows]
+        return np.array([any(start <= t < end for start, end in bounds) for t in times], dtype=bool)
+
+    def evict(self, now: datetime) -> "HorizonPlan":
+        # Drop the slots that have ended
+        start = 0
+        while start < len(self.times) and self.times[start] + timedelta(seconds=float(self.durations[start])) <= now:
+            start += 1
+        if start == 0:
+            return self
+        return HorizonPlan(
+            self.key,
+            self.times[start:],
+            self.durations[start:],
+            self.prices[start:],
+            self.candidates[start:],
+            self.charge[start:],
+            self.solar_kwh[start:],
+            self.projected_soc[start:],
+        )
+
+    def same_as(self, other: Optional["HorizonPlan"]) -> bool:
+        if other is self:
+            return True
+        if other is None or self.times != other.times:
+            return False
+        return all(np.array_equal(a, b) for a, b in zip(self.arrays(), other.arrays()))
+
+    def arrays(self) -> tuple:
+        return self.durations, self.prices, self.candidates, self.charge, self.solar_kwh, self.projected_soc
+
+    def next_charge(self) -> Optional[datetime]:
+        for t, charge in zip(self.times, self.charge):
+            if charge:
+                return t
+        return None
+
+    def windows(self, mask: np.ndarray) -> List[List[str]]:
+        # [start, end] of every run of consecutive selected slots
+        windows = []
+        for i in np.flatnonzero(mask):
+            start, end = self.times[i], self.times[i] + timedelta(seconds=float(self.durations[i]))
+            if windows and windows[-1][1] == start.isoformat():
+                windows[-1][1] = end.isoformat()
+            else:
+                windows.append([start.isoformat(), end.isoformat()])
+        return windows
+
+    def attributes(self) -> Dict[str, Any]:
+        # Per-slot values as parallel lists and the slot flags as windows, so 192 quarter hour slots
+        # stay well below the recorder's 16 KB limit for attributes
+        # One slot length, or the length of every slot when hourly and quarter hour prices are mixed
+        minutes = [int(d // 60) for d in self.durations]
+        return {
+            "start": self.times[0].isoformat() if self.times else None,
+            "interval_minutes": minutes[0] if len(set(minutes)) == 1 else minutes,
+            "prices": [round(float(price), 4) for price in self.prices],
+            "projected_soc": [round(float(soc), 3) for soc in self.projected_soc],
+            "solar_kwh": [round(float(solar), 3) for solar in self.solar_kwh],
+            "candidate_windows": self.windows(self.candidates),
+            "charge_windows": self.windows(self.charge),
+        }
+
+
+class PlanningStats:
+    """Stage timings, counters and the decision of one planning run."""
+
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.duration = 0.0
+        self.stages: Dict[str, float] = {}
+        self.counters: Dict[str, int] = {}
+        self.decision = "none"
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def count(self, name: str, amount: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def finish(self) -> None:
+        self.duration = time.perf_counter() - self.started
+
+    def attributes(self) -> Dict[str, Any]:
+        attributes: Dict[str, Any] = {"duration_ms": round(self.duration * 1000, 3)}
+        for name, seconds in self.stages.items():
+            attributes[f"{name}_ms"] = round(seconds * 1000, 3)
+        attributes.update(self.counters)
+        return attributes
+
+    def prometheus(self, decisions: Dict[str, int]) -> str:
+        lines = [
+            "# HELP smart_battery_planning_duration_seconds Duration of the last planning run.",
+            "# TYPE smart_battery_planning_duration_seconds gauge",
+            f"smart_battery_planning_duration_seconds {self.duration:.6f}",
+            "# HELP smart_battery_planning_stage_seconds Duration of each stage in the last planning run.",
+            "# TYPE smart_battery_planning_stage_seconds gauge",
+        ]
+        lines += [f'smart_battery_planning_stage_seconds{{stage="{name}"}} {seconds:.6f}' for name, seconds in self.stages.items()]
+        lines += [
+            "# HELP smart_battery_planning_events Counted events (state reads, cache hits) in the last planning run.",
+            "# TYPE smart_battery_planning_events gauge",
+        ]
+        lines += [f'smart_battery_planning_events{{event="{name}"}} {count}' for name, count in self.counters.items()]
+        lines += [
+            "# HELP smart_battery_planning_runs_total Planning runs by decision.",
+            "# TYPE smart_battery_planning_runs_total counter",
+        ]
+        lines += [f'smart_battery_planning_runs_total{{decision="{name}"}} {count}' for name, count in decisions.items()]
+        return "\n".join(lines) + "\n"
+
 
 class SmartBatteryManager(hass.Hass):
 
+    _price_snapshot: Optional[PriceSnapshot] = None
+    _plan_key: Optional[int] = None
+    # Slots the last full planning run charges in and its decision, what ticks with unchanged inputs look up
+    _plan_slots: Optional[List[datetime]] = None
+    _plan_decision: str = "none"
+    # SoC the last full planning run planned with, smaller drops than replan_soc_drop keep its plan
+    _plan_soc: Optional[float] = None
+    _replan_handle: Optional[str] = None
+    _always_charge_threshold: float = float('-inf')
+    # (start, end) of the charge session that is running or about to start
+    _charge_session: Optional[tuple] = None
+    # State of the configured entities for the planning run in progress, only set while holding the planning lock
+    _state: Optional[StateSnapshot] = None
+    # Full horizon plan of the last planning run and the optimal slots of the run in progress
+    _horizon_plan: Optional[HorizonPlan] = None
+    _optimal_slots: Optional[List[datetime]] = None
+    _solar_profile: Optional[SolarProfile] = None
+    _load_profile: Optional[LoadProfile] = None
+    _smoother: Optional[PriceSmoother] = None
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.init_planner_state()
+
+    def init_planner_state(self) -> None:
+        # Ticks and input replans can run on different executor threads in async mode, only one plans at a time
+        self._planning_lock = threading.Lock()
+        # Pending start_charging timers, keyed by the slot they start
+        self._charge_timers: Dict[datetime, str] = {}
+        # Instrumentation of the current (or last) planning run and decisions made so far
+        self._stats = PlanningStats()
+        self._decisions: Dict[str, int] = {}
+        # Parsed today/tomorrow price blocks of the last sensor update, reused while their raw entries are unchanged
+        self._price_blocks: List[tuple] = []
+        # Attributes of the last published plan and the plan they were formatted from
+        self._published_plan: Optional[Dict[str, Any]] = None
+        self._published_horizon: Optional[HorizonPlan] = None
+        # Batteries planned by this app in fleet mode
+        self._members: List["SmartBatteryManager"] = []
+        self._fleet_pool: Optional[ThreadPoolExecutor] = None
+        # Warm-start cache file and the last content written to it
+        self._cache_file: Optional[str] = None
+        self._cache_written: Optional[str] = None
+
+    def get_state(self, *args: Any, **kwargs: Any) -> Any:
+        self._stats.count("get_state")
+        return super().get_state(*args, **kwargs)
+
     def initialize(self) -> None:
         self.log("Smart battery manager initializing...")
+        self.init_fleet()
+        if not self._members:
+            self._cache_file = self.args.get("cache_file", os.path.join(os.path.dirname(os.path.abspath(__file__)), "smart_battery_cache.json"))
+            self.load_cache()
         now = datetime.now()
         first_run = now.replace(second=0, microsecond=0)
         if now.minute % 15 == 14:
@@ -15,44 +685,410 @@ class SmartBatteryManager(hass.Hass):
             first_run = first_run.replace(minute=(now.minute // 15) * 15 + 14)
         if first_run < now:
             first_run += timedelta(minutes=15)
-        self.run_every(self.plan_charging, first_run, 900)  # 900 seconds = 15 minutes
-        self.run_in(self.plan_charging, 5)  # Initial run after 5 seconds
+        self.run_every(self.get_planning_callback(), first_run, 900)  # 900 seconds = 15 minutes
+        self.run_in(self.get_planning_callback(), 5)  # Initial run after 5 seconds
+
+        # Replan as soon as an input changes instead of waiting for the next tick
+        attribute_entities = self.get_attribute_entities()
+        for entity in self.get_input_entities():
+            if entity in attribute_entities:
+                # Tibber prices and solar profiles are published as attributes, the state alone does not change
+                self.listen_state(self.on_input_change, entity, attribute="all")
+            else:
+                self.listen_state(self.on_input_change, entity)
+
+    def get_solar_arrays(self) -> List[Dict[str, str]]:
+        solar_arrays = self.args.get("solar_arrays")
+        if solar_arrays:
+            return solar_arrays
+        # Older configurations name the sensors of two arrays directly
+        return [
+            {
+                "energy_next_hour": self.args.get(f"energy_next_hour_sensor_{i}"),
+                "energy_today_remaining": self.args.get(f"energy_today_remaining_sensor_{i}"),
+            }
+            for i in (1, 2)
+            if self.args.get(f"energy_next_hour_sensor_{i}") or self.args.get(f"energy_today_remaining_sensor_{i}")
+        ]
+
+    def init_fleet(self) -> None:
+        batteries = self.args.get("batteries")
+        if not batteries:
+            return
+        stagger = self.args.get("charge_stagger_seconds", 30)
+        for i, battery in enumerate(batteries):
+            name = battery.get("name", f"battery_{i + 1}")
+            # Shared settings (prices, planner, thresholds) come from the app, the battery overrides the rest
+            args = {key: value for key, value in self.args.items() if key not in ("batteries", "metrics_file")}
+            args.update({
+                "planner_sensor": f"sensor.smart_battery_planner_{name}",
+                "plan_sensor": f"sensor.smart_battery_plan_{name}",
+            })
+            args.update(battery)
+            self._members.append(FleetBattery(self, name, args, stagger * i))
+        self._fleet_pool = ThreadPoolExecutor(
+            max_workers=self.args.get("fleet_workers", len(self._members)), thread_name_prefix="smart_battery_fleet"
+        )
+        self.log(f"Fleet mode with {len(self._members)} batteries: {', '.join(m.name for m in self._members)}")
+
+    def terminate(self) -> None:
+        if self._fleet_pool is not None:
+            self._fleet_pool.shutdown(wait=False)
+
+    def get_input_entities(self) -> List[str]:
+        if self._members:
+            return list(dict.fromkeys(entity for member in self._members for entity in member.get_input_entities()))
+        entities = [self.args.get("soc_sensor"), self.args.get("tibber_sensor")]
+        for solar_array in self.get_solar_arrays():
+            entities += [
+                solar_array.get("energy_next_hour"),
+                solar_array.get("energy_today_remaining"),
+                solar_array.get("forecast"),
+            ]
+        return [entity for entity in entities if entity]
+
+    def get_attribute_entities(self) -> List[str]:
+        # Inputs whose data lives in their attributes, they are tracked by last_updated
+        if self._members:
+            return list(dict.fromkeys(entity for member in self._members for entity in member.get_attribute_entities()))
+        entities = [self.args.get("tibber_sensor")] + self.get_solar_forecast_entities()
+        return [entity for entity in entities if entity]
+
+    def get_solar_forecast_entities(self) -> List[str]:
+        return [a["forecast"] for a in self.get_solar_arrays() if a.get("forecast")]
+
+    def get_planning_callback(self):
+        # async_planning runs planning as a coroutine on the AppDaemon event loop
+        if self.args.get("async_planning", False):
+            return self.plan_charging_async
+        return self.plan_charging
+
+    def get_input_domains(self) -> List[str]:
+        return sorted({entity.split(".", 1)[0] for entity in self.get_input_entities()})
+
+    def build_state_snapshot(self, domain_states: List[Optional[Dict[str, Any]]]) -> StateSnapshot:
+        entities = self.get_input_entities()
+        found: Dict[str, Dict[str, Any]] = {}
+        for states in domain_states:
+            for entity in entities:
+                if states and entity in states:
+                    found[entity] = states[entity]
+        return StateSnapshot(found)
 
-    def plan_charging(self, kwargs: Dict[str, Any]) -> None:
+    def take_state_snapshot(self) -> StateSnapshot:
+        # One bulk read per domain instead of one get_state per entity and attribute
+        return self.build_state_snapshot([self.get_state(domain, copy=False) for domain in self.get_input_domains()])
+
+    async def take_state_snapshot_async(self) -> StateSnapshot:
+        # In an async callback get_state returns awaitables, so all domains are read concurrently
+        domain_states = await asyncio.gather(*(self.get_state(domain, copy=False) for domain in self.get_input_domains()))
+        return self.build_state_snapshot(list(domain_states))
+
+    def read_state(self, entity_id: str, attribute: Optional[str] = None) -> Any:
+        # Within a planning run every read comes from the run's snapshot
+        if self._state is not None:
+            return self._state.get(entity_id, attribute)
+        if attribute is None:
+            return self.get_state(entity_id)
+        return self.get_state(entity_id, attribute=attribute)
+
+    def on_input_change(self, entity: str, attribute: str, old: Any, new: Any, kwargs: Dict[str, Any]) -> None:
+        if old == new:
+            return
+        # The SoC changes all the time while charging or discharging, only a larger drop needs a new plan
+        soc_batteries = [b for b in (self._members or [self]) if b.args.get("soc_sensor") == entity]
+        if soc_batteries and not any(b.soc_requires_replan(self.parse_soc(new)) for b in soc_batteries):
+            return
+        # Debounce: a burst of updates (e.g. both solar arrays) collapses into one replan
+        if self._replan_handle is not None:
+            self.cancel_timer(self._replan_handle, silent=True)
+        replan = self.replan_async if self.args.get("async_planning", False) else self.replan
+        self._replan_handle = self.run_in(replan, self.args.get("replan_debounce_seconds", 10))
+
+    def replan(self, kwargs: Dict[str, Any]) -> None:
+        self._replan_handle = None
+        self.plan_charging(kwargs)
+
+    async def replan_async(self, kwargs: Dict[str, Any]) -> None:
+        self._replan_handle = None
+        await self.plan_charging_async(kwargs)
+
+    def get_plan_key(self, next_interval: datetime) -> int:
+        # Besides the input entities, everything the decision reads that changes with the time of day: the SoC
+        # target and always charge check of the next interval, the 06:00 rule, the expected load over the next
+        # hour and the slot the solar balance starts from. The SoC is left to soc_requires_replan.
+        now = datetime.now()
+        attribute_entities = self.get_attribute_entities()
+        inputs: List[Any] = [
+            float(self.get_target_soc_profile([next_interval])[0]),
+            self.is_always_charge_interval(next_interval),
+            self.solar_day_started(now),
+        ]
+        if self.args.get("load_statistic"):
+            inputs.append(round(self.get_load_next_hour(), 3))
+        if self.get_solar_forecast_entities():
+            snapshot = self.get_price_snapshot()
+            inputs.append(snapshot.series.containing(now) if snapshot is not None else None)
+        for entity in self.get_input_entities():
+            if entity == self.args.get("soc_sensor"):
+                continue
+            if entity in attribute_entities:
+                inputs.append(self.read_state(entity, attribute="last_updated"))
+            else:
+                inputs.append(self.read_state(entity))
+        return hash(tuple(inputs))
+
+    async def plan_charging_async(self, kwargs: Dict[str, Any]) -> None:
+        try:
+            state = await self.take_state_snapshot_async()
+        except Exception as e:
+            self.log(f"Error reading planning inputs: {str(e)}")
+            return
+        # The decision itself is CPU bound and uses the sync API, so it runs on an executor thread
+        await self.run_in_executor(self.plan_charging, kwargs, state)
+
+    def plan_charging(self, kwargs: Dict[str, Any], state: Optional[StateSnapshot] = None) -> None:
+        with self._planning_lock:
+            if self._members:
+                self.plan_fleet(kwargs, state)
+            else:
+                self.run_planning(kwargs, state)
+
+    def run_planning(self, kwargs: Dict[str, Any], state: Optional[StateSnapshot]) -> None:
+        stats = self._stats = PlanningStats()
         try:
             now = datetime.now()
             next_interval = now.replace(second=0, microsecond=0) + timedelta(minutes=15 - now.minute % 15)
 
-            # Get battery state of charge (SoC)
-            soc = self.get_current_soc()
-            if soc is None:
+            # Nothing to do if the inputs are the same as in the last completed planning run
+            with stats.stage("inputs"):
+                self._state = state if state is not None else self.take_state_snapshot()
+                plan_key = self.get_plan_key(next_interval)
+            unchanged = plan_key == self._plan_key and not self.soc_requires_replan(self.get_current_soc())
+            charge_slots = self.get_cached_charge_slots(next_interval) if unchanged else None
+            if charge_slots is not None:
+                # Same inputs as the last full run, the tick only checks the next slot against its plan
+                stats.count("plan_cache_hit")
+                stats.decision = "unchanged"
+                self.log("Planning inputs unchanged, using the cached charge plan")
+            else:
+                self._plan_key = plan_key
+                self._optimal_slots = None
+                charge_slots = self.should_charge(next_interval)
+                self._plan_decision = stats.decision
+
+            with stats.stage("schedule"):
+                if charge_slots is not None:
+                    session_end = self.build_charge_session(next_interval, charge_slots) if charge_slots else None
+                    self.update_charge_session(next_interval, session_end)
+            if charge_slots is not None and self.get_plan_sensor():
+                with stats.stage("plan"):
+                    self.update_horizon_plan(next_interval, rebuild=stats.decision != "unchanged")
+
+        except Exception as e:
+            self._plan_key = None
+            stats.decision = "error"
+            self.log(f"Error during planning: {str(e)}")
+        finally:
+            self._state = None
+            stats.finish()
+            self.publish_planning_stats(stats)
+            self.save_cache()
+
+    def soc_requires_replan(self, soc: Optional[float]) -> bool:
+        # A new plan is needed when the SoC dropped by more than replan_soc_drop percent since the last full run,
+        # the battery became full or the SoC is unknown. A rising SoC keeps the plan.
+        planned = self._plan_soc
+        if soc is None or planned is None or (soc >= 1.0) != (planned >= 1.0):
+            return True
+        return planned - soc > self.args.get("replan_soc_drop", 5) / 100
+
+    def get_cached_charge_slots(self, next_interval: datetime) -> Optional[List[datetime]]:
+        # The charge slots for the next interval from the cached plan, None when a full run is needed
+        if self._plan_slots is None:
+            return None
+        if self.is_next_interval_candidate(next_interval, self._plan_slots):
+            return self._plan_slots
+        # Outside the always charge slots the regular checks decide
+        return None if self._plan_decision == "always_charge" else []
+
+    def plan_fleet(self, kwargs: Dict[str, Any], state: Optional[StateSnapshot] = None) -> None:
+        stats = self._stats = PlanningStats()
+        try:
+            # One state read and one price parse for all batteries
+            with stats.stage("inputs"):
+                state = self._state = state if state is not None else self.take_state_snapshot()
+            with stats.stage("prices"):
+                if self.get_price_snapshot() is not None:
+                    self.get_candidate_hours()
+            with stats.stage("batteries"):
+                list(self._fleet_pool.map(lambda member: member.plan_charging(kwargs, state), self._members))
+            stats.decision = "fleet"
+        except Exception as e:
+            stats.decision = "error"
+            self.log(f"Error during fleet planning: {str(e)}")
+        finally:
+            self._state = None
+            stats.finish()
+            self.publish_planning_stats(stats)
+
+    def get_cache_state(self) -> Dict[str, Any]:
+        snapshot = self._price_snapshot
+        session = self._charge_session
+        timers = []
+        for slot in sorted(self._charge_timers):
+            if session is not None and slot == session[1] and slot != session[0]:
+                timers.append({"slot": slot.isoformat(), "action": "stop"})
+                continue
+            # Start timers inside a session charge until its end
+            covered = session is not None and session[0] <= slot < session[1]
+            duration = int((session[1] - slot).total_seconds() // 60) if covered else None
+            timers.append({"slot": slot.isoformat(), "action": "start", "duration": duration})
+        return {
+            "version": 2,
+            "tibber_updated": snapshot.key if snapshot is not None else None,
+            "prices": [[t.isoformat(), p] for t, p in snapshot.parsed] if snapshot is not None else [],
+            "plan": self._published_plan,
+            "session": [t.isoformat() for t in session] if session is not None else None,
+            "timers": timers,
+        }
+
+    def save_cache(self) -> None:
+        if not self._cache_file:
+            return
+        try:
+            content = json.dumps(self.get_cache_state(), separators=(",", ":"))
+            if content == self._cache_written:
                 return
+            # Write to a temporary file and rename so a restart never reads a partial file
+            tmp_file = f"{self._cache_file}.tmp"
+            with open(tmp_file, "w") as f:
+                f.write(content)
+            os.replace(tmp_file, self._cache_file)
+            self._cache_written = content
+        except Exception as e:
+            self.log(f"Error writing planner cache: {str(e)}")
 
-            # Check if battery is fully charged
-            if soc >= 1.0:
-                self.log("Battery is fully charged, no need to charge")
+    def load_cache(self) -> None:
+        if not self._cache_file or not os.path.exists(self._cache_file):
+            return
+        try:
+            with open(self._cache_file) as f:
+                cache = json.load(f)
+            tibber_updated = self.read_state(self.args["tibber_sensor"], attribute="last_updated")
+            if cache.get("version") != 2 or not tibber_updated or cache.get("tibber_updated") != tibber_updated:
+                self.log("Planner cache is out of date, waiting for the first planning run")
                 return
 
-            # Charge if price is below always charge threshold
+            key = cache["tibber_updated"]
+            self._price_snapshot = PriceSnapshot(key, [], [(parser.isoparse(t), p) for t, p in cache["prices"]])
+            now = datetime.now()
+            plan = cache.get("plan")
+            if plan and plan["start"]:
+                self._horizon_plan = HorizonPlan.from_attributes(key, self._price_snapshot, plan).evict(now)
+            session = cache.get("session")
+            self._charge_session = tuple(parser.isoparse(t) for t in session) if session else None
+            self.restore_charge_timers(cache.get("timers", []), now)
+            self.log(f"Restored planner cache: {len(self._price_snapshot)} prices, {len(self._charge_timers)} charge timers")
+        except Exception as e:
+            self.log(f"Ignoring planner cache {self._cache_file}: {str(e)}")
+
+    def restore_charge_timers(self, timers: List[Dict[str, Any]], now: datetime) -> None:
+        session = self._charge_session
+        for timer in timers:
+            slot = parser.isoparse(timer["slot"])
+            if timer["action"] == "stop":
+                if slot > now:
+                    self._charge_timers[slot] = self.run_at(self.stop_charging, slot, slot=slot)
+            elif slot >= now:
+                self.schedule_charge(slot, timer.get("duration"))
+            elif session is not None and slot >= session[0] and now < session[1]:
+                # The session should have started while the app was down, start it now for the time that is left
+                remaining = int((session[1] - now).total_seconds() // 60)
+                self.log(f"Catching up missed charge at {slot.strftime('%Y-%m-%d %H:%M')}")
+                self._charge_timers[slot] = self.run_in(
+                    self.start_charging, 1, hour=slot.hour, minute=slot.minute, slot=slot, duration=remaining
+                )
+
+    def publish_planning_stats(self, stats: PlanningStats) -> None:
+        self._decisions[stats.decision] = self._decisions.get(stats.decision, 0) + 1
+        try:
+            planner_sensor = self.args.get("planner_sensor", "sensor.smart_battery_planner")
+            if planner_sensor:
+                self.set_state(planner_sensor, state=stats.decision, attributes={
+                    **stats.attributes(),
+                    "charge_timers": len(self._charge_timers),
+                    "friendly_name": "Smart battery planner",
+                })
+            metrics_file = self.args.get("metrics_file")
+            if metrics_file:
+                # Write to a temporary file and rename so scrapers never see a partial file
+                tmp_file = f"{metrics_file}.tmp"
+                with open(tmp_file, "w") as f:
+                    f.write(stats.prometheus(self._decisions))
+                os.replace(tmp_file, metrics_file)
+        except Exception as e:
+            self.log(f"Error publishing planner statistics: {str(e)}")
+
+    def should_charge(self, next_interval: datetime) -> Optional[List[datetime]]:
+        # Returns the charge slots the next interval belongs to, an empty list to not charge
+        # and None when there is not enough data to decide. The slots the same inputs would charge in
+        # are kept in _plan_slots for the ticks that follow.
+        stats = self._stats
+        self._plan_slots = None
+
+        # Get battery state of charge (SoC)
+        with stats.stage("soc"):
+            soc = self._plan_soc = self.get_current_soc()
+        if soc is None:
+            stats.decision = "no_data"
+            return None
+
+        # Check if battery is fully charged
+        if soc >= 1.0:
+            stats.decision = "full"
+            self.log("Battery is fully charged, no need to charge")
+            self._plan_slots = []
+            return []
+
+        # Charge if price is below always charge threshold
+        with stats.stage("always_charge"):
             if self.check_always_charge(next_interval):
-                return
-  
-            # Check if we need to charge based on solar production
+                stats.decision = "always_charge"
+                self._plan_slots = self.get_always_charge_slots()
+                return self._plan_slots
+
+        if self.args.get("planner", "heuristic") == "optimal":
+            with stats.stage("candidates"):
+                charge_slots = self._plan_slots = self.get_optimal_charge_slots(soc, next_interval)
+            if self.is_next_interval_candidate(next_interval, charge_slots):
+                stats.decision = "charge"
+                return charge_slots
+            stats.decision = "not_candidate"
+            self.log("Skipping charge: Next interval is not in the optimal charge plan")
+            return []
+
+        # Check if we need to charge based on solar production
+        with stats.stage("target"):
             target_soc = self.get_target_soc(next_interval)
             energy_needed = self.calculate_energy_needed(soc, target_soc)
-            self.log(f"Current battery SoC: {soc*100:.0f}%, energy needed from grid: {energy_needed:.2f} kWh")         
-            if self.check_skip_charge(soc, target_soc, energy_needed):
-                return
-
-            # Check if the next interval is a candidate for charging
-            candidate_hours = self.get_candidate_hours()
-            if self.is_next_interval_candidate(next_interval, candidate_hours):
-                self.schedule_charge(next_interval)
-            else:
-                self.log("Skipping charge: Next interval is not a candidate for charging")
+        self.log(f"Current battery SoC: {soc*100:.0f}%, energy needed from grid: {energy_needed:.2f} kWh")
+        with stats.stage("skip_check"):
+            skip = self.check_skip_charge(soc, target_soc, energy_needed)
+        if skip:
+            stats.decision = "skip"
+            self._plan_slots = []
+            return []
 
-        except Exception as e:
-            self.log(f"Error during planning: {str(e)}")
+        # Check if the next interval is a candidate for charging
+        with stats.stage("candidates"):
+            candidate_hours = self._plan_slots = self.get_candidate_hours()
+        if self.is_next_interval_candidate(next_interval, candidate_hours):
+            stats.decision = "charge"
+            return candidate_hours
+        stats.decision = "not_candidate"
+        self.log("Skipping charge: Next interval is not a candidate for charging")
+        return []
 
     def check_always_charge(self, next_interval: datetime) -> bool:
         mean_price = self.get_mean_price()
@@ -64,65 +1100,134 @@ class SmartBatteryManager(hass.Hass):
         else:
             self.log(f"Always charge threshold: {always_charge_threshold:.2f}")
 
+        self._always_charge_threshold = always_charge_threshold
         next_interval_price = self.get_price_for_interval(next_interval)
-        if next_interval_price is not None and next_interval_price < always_charge_threshold:
+        if next_interval_price is None:
+            return False
+        if next_interval_price < always_charge_threshold:
             self.log(f"Next interval price: {next_interval_price:.2f} is below always charge threshold of {always_charge_threshold:.2f}")
-            self.schedule_charge(next_interval)
             return True
         else:
             self.log(f"Next interval price: {next_interval_price:.2f} is above always charge threshold of {always_charge_threshold:.2f}")
             return False
 
+    def is_always_charge_interval(self, next_interval: datetime) -> bool:
+        # The always charge check of check_always_charge without logging, for the plan key
+        if not self.args.get("tibber_sensor"):
+            return False
+        snapshot = self.get_price_snapshot()
+        price = snapshot.price_at(next_interval) if snapshot is not None else None
+        if price is None:
+            return False
+        always_charge_factor = self.args.get("always_charge_factor", 0.0)
+        mean_price = snapshot.future_mean(datetime.now())
+        return always_charge_factor <= 0 or price < (mean_price or 0.0) * always_charge_factor
+
+    def get_always_charge_slots(self) -> List[datetime]:
+        snapshot = self.get_price_snapshot()
+        if snapshot is None:
+            return []
+        below = snapshot.prices < self._always_charge_threshold
+        return [t for t, selected in zip(snapshot.times, below) if selected]
+
     def get_mean_price(self) -> float:
-        all_prices = self.get_all_prices()
-        if not all_prices:
+        snapshot = self.get_price_snapshot()
+        if snapshot is None:
             self.log("No price data available")
             return 0.0
-        now = datetime.now()
         # Only consider prices from now onwards
-        future_prices = [p[1] for p in all_prices if p[0] >= now]
-        if not future_prices:
+        mean_price = snapshot.future_mean(datetime.now())
+        if mean_price is None:
             self.log("No future price data available")
             return 0.0
-        mean_price = sum(future_prices) / len(future_prices)
         self.log(f"Mean price (current and future): {mean_price:.2f}")
         return mean_price
     
     def get_current_soc(self) -> Optional[float]:
-        soc_raw = self.get_state(self.args["soc_sensor"])
-        if soc_raw is None or soc_raw in ["unknown", "unavailable"]:
+        soc = self.parse_soc(self.read_state(self.args["soc_sensor"]))
+        if soc is None:
             self.log("Battery SoC sensor returned no data.")
+        return soc
+
+    @staticmethod
+    def parse_soc(soc_raw: Any) -> Optional[float]:
+        if soc_raw is None or soc_raw in ["unknown", "unavailable"]:
             return None
         return float(soc_raw) / 100
 
     def get_target_soc(self, next_interval: datetime) -> float:
         soc_targets = self.args.get("soc_targets")
-        if not soc_targets or len(soc_targets) != 24:
+        if not soc_targets or len(soc_targets) not in (24, 96):
             self.log("Invalid or missing battery SoC target array, using default 90%")
             return 0.9
-        target_soc = soc_targets[next_interval.hour]
-        self.log(f"Selected target battery SoC for hour {next_interval.hour}: {target_soc * 100:.0f}%")
+        target_soc = soc_targets[self.get_target_index(next_interval, len(soc_targets))]
+        slot = f"hour {next_interval.hour}" if len(soc_targets) == 24 else next_interval.strftime("%H:%M")
+        self.log(f"Selected target battery SoC for {slot}: {target_soc * 100:.0f}%")
         return target_soc
 
+    def get_target_soc_profile(self, times: List[datetime]) -> np.ndarray:
+        soc_targets = self.args.get("soc_targets")
+        if not soc_targets or len(soc_targets) not in (24, 96):
+            return np.full(len(times), 0.9)
+        return np.array([soc_targets[self.get_target_index(t, len(soc_targets))] for t in times], dtype=float)
+
+    def get_target_index(self, when: datetime, count: int) -> int:
+        # Targets are per hour (24) or per quarter hour (96) of the local day
+        return (when.hour * 60 + when.minute) * count // 1440
+
     def calculate_energy_needed(self, soc: float, target_soc: float) -> float:
         battery_capacity = self.args.get("battery_capacity_kwh", 10)
-        energy_needed = max(0, (target_soc - soc) * battery_capacity)
+        energy_needed = max(0, (target_soc - soc) * battery_capacity + self.get_load_next_hour())
         return energy_needed
 
+    def get_load_profile(self) -> Optional[LoadProfile]:
+        statistic = self.args.get("load_statistic")
+        if not statistic:
+            return None
+        if self._load_profile is None:
+            self._load_profile = LoadProfile(
+                self.args.get("recorder_db", "/config/home-assistant_v2.db"),
+                statistic,
+                self.args.get("load_history_days", 28),
+            )
+        try:
+            # Only reads the statistics rows written since the last update
+            self._stats.count("load_rows", self._load_profile.update())
+        except Exception as e:
+            self.log(f"Could not read load statistics: {str(e)}")
+        return self._load_profile
+
+    def get_load_next_hour(self) -> float:
+        profile = self.get_load_profile()
+        if profile is None:
+            return 0.0
+        now = datetime.now()
+        return profile.energy_between(now, now + timedelta(hours=1))
+
+    def get_expected_load(self, times: List[datetime], durations: np.ndarray) -> Optional[np.ndarray]:
+        profile = self.get_load_profile()
+        return profile.slot_energy(times, durations) if profile is not None else None
+
     def get_solar_next_hour(self) -> float:
-        solar_next_hour_1 = self.get_state(self.args["energy_next_hour_sensor_1"])
-        solar_next_hour_2 = self.get_state(self.args["energy_next_hour_sensor_2"])
+        profile = self.get_solar_forecast()
+        if profile is not None:
+            now = datetime.now()
+            return profile.energy_between(now, now + timedelta(hours=1))
+        sensors = [a["energy_next_hour"] for a in self.get_solar_arrays() if a.get("energy_next_hour")]
         try:
-            return float(solar_next_hour_1 or 0) + float(solar_next_hour_2 or 0)
+            return sum(float(self.read_state(sensor) or 0) for sensor in sensors)
         except ValueError:
             self.log("Could not parse solar forecast data, assuming 0 kWh")
             return 0
 
     def get_solar_remaining(self) -> float:
-        solar_remaining_1 = self.get_state(self.args["energy_today_remaining_sensor_1"])
-        solar_remaining_2 = self.get_state(self.args["energy_today_remaining_sensor_2"])
+        profile = self.get_solar_forecast()
+        if profile is not None:
+            now = datetime.now()
+            return profile.energy_between(now, now.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1))
+        sensors = [a["energy_today_remaining"] for a in self.get_solar_arrays() if a.get("energy_today_remaining")]
         try:
-            return float(solar_remaining_1 or 0) + float(solar_remaining_2 or 0)
+            return sum(float(self.read_state(sensor) or 0) for sensor in sensors)
         except ValueError:
             self.log("Could not parse remaining solar production data, assuming 0 kWh")
             return 0
@@ -132,123 +1237,475 @@ class SmartBatteryManager(hass.Hass):
            self.log("Skipping charge: No additional energy needed")
            return True
 
+        if self.get_solar_forecast() is not None:
+            # With forecast profiles the cumulative balance over the rest of the day decides
+            if self.solar_covers_targets(soc):
+                self.log("Skipping charge: Expected solar production keeps the battery above the SoC targets today")
+                return True
+            return False
+
+        # Without profiles, fall back to the next hour and remaining today sensors
         solar_next_hour = self.get_solar_next_hour()
         solar_remaining = self.get_solar_remaining()
 
         self.log(f"Expected solar production next hour: {solar_next_hour:.2f} kWh")
         self.log(f"Expected remaining solar production today: {solar_remaining:.2f} kWh")
    
-        now = datetime.now()
-        if solar_remaining > 2 * energy_needed and now.time() > datetime.strptime("06:00", "%H:%M").time():
+        if solar_remaining > 2 * energy_needed and self.solar_day_started(datetime.now()):
             self.log("Skipping charge: Expected remaining solar production today is more than double the energy needed")
             return True
 
-        projected_soc = soc + (solar_next_hour / self.args.get("battery_capacity_kwh", 10))
+        projected_soc = soc + ((solar_next_hour - self.get_load_next_hour()) / self.args.get("battery_capacity_kwh", 10))
         if projected_soc >= target_soc:
             self.log(f"Skipping charge: Expected solar next hour is enough to reach SoC target")
             return True
 
         return False
 
-    def get_all_prices(self) -> List[tuple]:
-        price_data_full = self.get_state(self.args["tibber_sensor"], attribute="all")
+    def solar_day_started(self, now: datetime) -> bool:
+        # Remaining solar production is only trusted to cover the day after 06:00
+        return now > now.replace(hour=6, minute=0, second=0, microsecond=0)
+
+    def get_solar_forecast(self) -> Optional[SolarProfile]:
+        entities = self.get_solar_forecast_entities()
+        if not entities:
+            return None
+        snapshot = self.get_price_snapshot()
+        if snapshot is None or not len(snapshot):
+            return None
+
+        # Only re-read the profiles when a forecast entity or the price grid has been updated
+        updated = tuple(self.read_state(entity, attribute="last_updated") for entity in entities)
+        key = (snapshot.key, updated)
+        cached = self._solar_profile
+        if cached is not None and snapshot.key is not None and None not in updated and cached.key == key:
+            self._stats.count("solar_cache_hit")
+            return cached
+        self._stats.count("solar_cache_miss")
+
+        series = snapshot.series
+        energy = np.zeros(len(snapshot))
+        found = False
+        for entity in entities:
+            state = self.read_state(entity, attribute="all") or {}
+            periods = solar_forecast_periods(state.get("attributes") or {})
+            if periods is None:
+                self.log(f"No solar forecast profile found on {entity}")
+                continue
+            energy += align_energy(*periods, series.utc, series.ends)
+            found = True
+        if not found:
+            self._solar_profile = None
+            return None
+
+        self._solar_profile = SolarProfile(key, series, energy)
+        return self._solar_profile
+
+    def solar_covers_targets(self, soc: float) -> bool:
+        # Cumulative energy balance over the rest of today: skip grid charging when the forecast solar
+        # alone keeps the battery at or above the SoC target at the end of every slot
+        profile = self.get_solar_forecast()
+        if profile is None:
+            return False
+        now = datetime.now()
+        end = now.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+        start = profile.series.containing(now)
+        stop = profile.series.searchsorted(end)
+        if stop <= start:
+            return False
+        times = profile.times[start:stop]
+        targets = self.get_target_soc_profile(times)
+        load = self.get_expected_load(times, profile.series.durations[start:stop])
+        net_kwh = profile.energy[start:stop] - (load if load is not None else 0.0)
+        # SoC without grid charging. Solar beyond a full battery is lost, so the highest overflow so far is
+        # taken off. An empty battery is not floored at 0, it already misses any target above 0.
+        level = soc + np.cumsum(net_kwh) / self.args.get("battery_capacity_kwh", 10)
+        level -= np.maximum.accumulate(np.maximum(level - 1.0, 0.0))
+        return bool(np.all(level >= targets - 1e-9))
+
+    def get_price_snapshot(self) -> Optional[PriceSnapshot]:
+        tibber_sensor = self.args["tibber_sensor"]
+        # Only re-read and re-parse the attribute blob when the sensor has been updated
+        key = self.read_state(tibber_sensor, attribute="last_updated")
+        cached = self._price_snapshot
+        if cached is not None and key is not None and cached.key == key:
+            self._stats.count("price_cache_hit")
+            return cached
+        self._stats.count("price_cache_miss")
+
+        price_data_full = self.read_state(tibber_sensor, attribute="all")
         if not price_data_full or "attributes" not in price_data_full:
             self.log("No price data attributes found")
-            return []
+            return None
 
         price_data = price_data_full["attributes"]
         tibber_prices = price_data.get("today", []) + price_data.get("tomorrow", [])
         if not tibber_prices:
             self.log("No price data available")
-            return []
+            return None
 
-        return [
-            (parser.isoparse(e["startsAt"]).replace(tzinfo=None), float(e["total"]))
-            for e in tibber_prices
-        ]
+        key = price_data_full.get("last_updated") or price_data_full.get("last_changed") or key
+        snapshot = PriceSnapshot(key, tibber_prices, self.parse_price_blocks(price_data))
+        self._price_snapshot = snapshot if key is not None else None
+        return snapshot
 
-    def get_price_for_interval(self, interval: datetime) -> Optional[float]:
-        all_prices = self.get_all_prices()
-        for start_time, price in all_prices:
-            # Match only the date and hour, ignoring the minutes
-            if start_time.date() == interval.date() and start_time.hour == interval.hour:
-                return price
+    def parse_price_blocks(self, price_data: Mapping[str, Any]) -> List[tuple]:
+        # When tomorrow's prices land (or yesterday's tomorrow becomes today) only the new block is parsed
+        blocks = []
+        for name in ("today", "tomorrow"):
+            raw = list(price_data.get(name) or [])
+            parsed = next((p for r, p in self._price_blocks if r == raw), None)
+            if parsed is None:
+                parsed = parse_price_entries(raw)
+            else:
+                self._stats.count("price_block_reused")
+            blocks.append((raw, parsed))
+        self._price_blocks = blocks
+        return [entry for _, parsed in blocks for entry in parsed]
 
-        self.log(f"No price found for interval: {interval}")
-        return None
+    def get_all_prices(self) -> List[tuple]:
+        snapshot = self.get_price_snapshot()
+        if snapshot is None:
+            return []
+        return snapshot.items()
+
+    def get_price_for_interval(self, interval: datetime) -> Optional[float]:
+        snapshot = self.get_price_snapshot()
+        price = snapshot.price_at(interval) if snapshot is not None else None
+        if price is None:
+            self.log(f"No price found for interval: {interval}")
+        return price
     
     def get_candidate_hours(self) -> List[datetime]:
-        all_prices = self.get_all_prices()
-        if not all_prices:
+        snapshot = self.get_price_snapshot()
+        if snapshot is None:
             self.log("No prices available to calculate candidate hours")
             return []
-        
-        all_prices.sort(key=lambda x: x[0])
+        if snapshot.candidates is not None:
+            self._stats.count("candidate_cache_hit")
+            return snapshot.candidates
+
+        # Minima are detected on the smoothed prices so small wiggles do not add candidates,
+        # they are then expanded over the actual prices
+        minima = local_minima_mask(self.get_smoothed_prices(snapshot))
+        self.log(f"Detected local minima: {self.format_times(snapshot.times, minima)}")
+        candidates = candidate_mask(snapshot.prices, minima, self.args.get("candidate_tolerance", 0.10))
+        self.log(f"Candidate hours: {self.format_times(snapshot.times, candidates)}")
+        snapshot.candidates = [t for t, selected in zip(snapshot.times, candidates) if selected]
+        return snapshot.candidates
 
-        local_minima = self.find_local_minima(all_prices)
-        return self.build_candidate_hours(local_minima, all_prices)
+    def get_smoothed_prices(self, snapshot: PriceSnapshot) -> np.ndarray:
+        method = self.args.get("smoothing_method", "mean")
+        window_minutes = self.args.get("smoothing_window_minutes", 180)
+        window = max(int(round(window_minutes * 60 / snapshot.interval.total_seconds())), 1)
+        smoother = self._smoother
+        if smoother is None or (smoother.method, smoother.window) != (method, window):
+            smoother = self._smoother = PriceSmoother(method, window)
+        smoothed = smoother.update(snapshot.series.utc, snapshot.prices)
+        self._stats.count("smoothed_slots", smoother.recomputed)
+        return smoothed
 
+    # List based wrappers around the same engine, planning uses get_candidate_hours
     def find_local_minima(self, all_prices: List[tuple]) -> List[datetime]:
-        local_minima = []
-        for i in range(1, len(all_prices) - 1):
-            if all_prices[i][1] < all_prices[i - 1][1] and all_prices[i][1] < all_prices[i + 1][1]:
-                local_minima.append(all_prices[i][0])
-        self.log(f"Detected local minima: {', '.join(t.strftime('%Y-%m-%d %H:%M') for t in local_minima)}")
-        return local_minima
+        times = [t for t, _ in all_prices]
+        minima = local_minima_mask(np.array([p for _, p in all_prices], dtype=float))
+        self.log(f"Detected local minima: {self.format_times(times, minima)}")
+        return [t for t, selected in zip(times, minima) if selected]
 
     def build_candidate_hours(self, local_minima: List[datetime], all_prices: List[tuple]) -> List[datetime]:
-        candidate_hours = set()
+        times = [t for t, _ in all_prices]
+        prices = np.array([p for _, p in all_prices], dtype=float)
+        wanted = set(local_minima)
+        minima = np.fromiter((t in wanted for t in times), dtype=bool, count=len(times))
+        candidates = candidate_mask(prices, minima, self.args.get("candidate_tolerance", 0.10))
+        self.log(f"Candidate hours: {self.format_times(times, candidates)}")
+        return sorted(t for t, selected in zip(times, candidates) if selected)
 
-        # Find mean price from all_prices
-        mean_price = sum(p[1] for p in all_prices) / len(all_prices)
+    def format_times(self, times: List[datetime], mask: np.ndarray) -> str:
+        return ', '.join(t.strftime('%Y-%m-%d %H:%M') for t, selected in zip(times, mask) if selected)
 
-        for minimum in local_minima:
-            # Get the price of the local minimum
-            min_price = next((p for (t, p) in all_prices if t == minimum), None)
-            if min_price is None:
-                continue
+    def get_optimal_charge_slots(self, soc: float, next_interval: datetime) -> List[datetime]:
+        snapshot = self.get_price_snapshot()
+        if snapshot is None:
+            self.log("No prices available to calculate the optimal charge plan")
+            return []
+
+        # Start at the slot containing the next interval
+        start = snapshot.series.containing(next_interval)
+        times = snapshot.times[start:]
+        if not times:
+            return []
+
+        durations = snapshot.series.durations[start:]
+        capacity = self.args.get("battery_capacity_kwh", 10)
+        charge_kwh = self.args.get("charge_power_w", 3000) / 1000 * durations / 3600
+
+        mask = optimal_charge_mask(
+            snapshot.prices[start:],
+            self.get_target_soc_profile(times),
+            self.get_solar_profile(start, next_interval),
+            soc,
+            capacity,
+            charge_kwh,
+            soc_steps=self.args.get("optimal_soc_steps", 1000),
+            load_kwh=self.get_expected_load(times, durations),
+        )
+        self.log(f"Optimal charge slots: {self.format_times(times, mask)}")
+        self._optimal_slots = [t for t, selected in zip(times, mask) if selected]
+        return self._optimal_slots
+
+    def get_solar_profile(self, start: int, next_interval: datetime) -> np.ndarray:
+        # Solar energy of the price slots from position start onwards. Positions stay unique when a local
+        # time occurs twice at the end of summer time.
+        profile = self.get_solar_forecast()
+        if profile is not None:
+            return profile.energy[start:]
+        # Without forecast profiles, spread the next hour's solar forecast over the slots it covers
+        times = self.get_price_snapshot().times[start:]
+        solar = np.zeros(len(times))
+        next_hour = np.array([t < next_interval + timedelta(hours=1) for t in times], dtype=bool)
+        if next_hour.any():
+            solar[next_hour] = self.get_solar_next_hour() / next_hour.sum()
+        return solar
+
+    def update_horizon_plan(self, next_interval: datetime, rebuild: bool = True) -> Optional[HorizonPlan]:
+        # The published plan is informational, failing to build it must not affect charging
+        try:
+            if rebuild or self._horizon_plan is None:
+                plan = self.build_horizon_plan(next_interval)
+            else:
+                # Inputs are unchanged since the plan was built, it only loses the slots that have ended
+                plan = self._horizon_plan.evict(datetime.now())
+            if plan is not None:
+                self._horizon_plan = plan
+                self.publish_horizon_plan(plan)
+            return plan
+        except Exception as e:
+            self.log(f"Error updating the charge plan: {str(e)}")
+            return None
+
+    def build_horizon_plan(self, next_interval: datetime) -> Optional[HorizonPlan]:
+        snapshot = self.get_price_snapshot()
+        soc = self.get_current_soc()
+        if snapshot is None or soc is None:
+            return None
+
+        # Slots that have already ended are dropped from the plan
+        start = snapshot.series.containing(datetime.now())
+        times = snapshot.times[start:]
+        prices = snapshot.prices[start:]
+        if self.args.get("planner", "heuristic") == "optimal":
+            if self._optimal_slots is None:
+                self.get_optimal_charge_slots(soc, next_interval)
+            selected = set(self._optimal_slots or [])
+            # The optimal plan already accounts for the targets, charge in every selected slot
+            targets = np.ones(len(times))
+        else:
+            selected = set(self.get_candidate_hours())
+            targets = self.get_target_soc_profile(times)
+        candidates = np.array([t in selected for t in times], dtype=bool) | (prices < self._always_charge_threshold)
 
-            # Explicitly add the local minimum to candidate hours
-            candidate_hours.add(minimum)
+        durations = snapshot.series.durations[start:]
+        solar = self.get_solar_profile(start, next_interval)
+        charge, projected = project_soc(
+            candidates,
+            targets,
+            solar,
+            soc,
+            self.args.get("battery_capacity_kwh", 10),
+            self.args.get("charge_power_w", 3000) / 1000 * durations / 3600,
+            self.get_expected_load(times, durations),
+        )
+        return HorizonPlan(snapshot.key, times, durations, prices, candidates, charge, solar, projected)
 
-            # Search left (past hours)
-            for t, p in reversed(all_prices):
-                if t < minimum and p <= min_price + 0.10 and p < mean_price:
-                    candidate_hours.add(t)
-                elif t < minimum:
-                    break  # Stop if the price is no longer below the threshold
+    def get_plan_sensor(self) -> Optional[str]:
+        return self.args.get("plan_sensor", "sensor.smart_battery_plan")
 
-            # Search right (future hours)
-            for t, p in all_prices:
-                if t > minimum and p <= min_price + 0.10 and p < mean_price:
-                    candidate_hours.add(t)
-                elif t > minimum:
-                    break  # Stop if the price is no longer below the threshold
+    def publish_horizon_plan(self, plan: HorizonPlan) -> None:
+        plan_sensor = self.get_plan_sensor()
+        if not plan_sensor:
+            return
+        # Only push the attributes when something in them changed, the arrays are compared before formatting them
+        if plan.same_as(self._published_horizon):
+            return
+        attributes = plan.attributes()
+        self._published_horizon = plan
+        if attributes == self._published_plan:
+            return
+        next_charge = plan.next_charge()
+        self.set_state(plan_sensor, state=next_charge.isoformat() if next_charge else "none", attributes={
+            **attributes,
+            "charge_slots": int(plan.charge.sum()),
+            "friendly_name": "Smart battery plan",
+        })
+        self._published_plan = attributes
 
-        candidate_hours = sorted(candidate_hours)
-        self.log(f"Candidate hours: {', '.join(t.strftime('%Y-%m-%d %H:%M') for t in candidate_hours)}")
-        return candidate_hours
+    def get_slot_start(self, when: datetime) -> datetime:
+        # Start of the price slot containing a time, an hourly slot among quarter hour ones starts on the hour
+        snapshot = self._price_snapshot
+        i = snapshot.slot_index(when) if snapshot is not None else None
+        if i is None:
+            return slot_start(when, snapshot.interval if snapshot is not None else timedelta(hours=1))
+        return snapshot.times[i]
 
     def is_next_interval_candidate(self, next_interval: datetime, candidate_hours: List[datetime]) -> bool:
-        return any(t.date() == next_interval.date() and t.hour == next_interval.hour for t in candidate_hours)
+        return self.get_slot_start(next_interval) in set(candidate_hours)
+
+    def build_charge_session(self, start: datetime, charge_slots: List[datetime]) -> datetime:
+        # Extend the session over every contiguous 15 minute interval that is also a charge slot
+        slots = set(charge_slots)
+        end = start
+        horizon = start + timedelta(days=2)
+        while end < horizon and self.get_slot_start(end) in slots:
+            end += timedelta(minutes=15)
+        return end
+
+    def update_charge_session(self, next_interval: datetime, session_end: Optional[datetime]) -> None:
+        session = self._charge_session
+        running = session is not None and session[0] < next_interval < session[1]
+
+        if session_end is None:
+            self.update_charge_timers([])
+            if running:
+                self.stop_charge_session(next_interval)
+            else:
+                # A pending session whose timer was just cancelled never starts
+                self._charge_session = None
+            return
+
+        if running:
+            if session[1] == session_end:
+                self.log(f"Charge session already running until {session_end.strftime('%Y-%m-%d %H:%M')}")
+                return
+            change = "Extending" if session_end > session[1] else "Shortening"
+            self.log(f"{change} charge session until {session_end.strftime('%Y-%m-%d %H:%M')}")
+            if session_end < session[1] and self.args.get("charge_stop_script"):
+                # The running script keeps its duration, stop it at the new end instead
+                self.update_charge_timers([])
+                self.stop_charge_session(session_end)
+                return
+            start = session[0]
+        else:
+            start = next_interval
+        if session != (start, session_end):
+            # Re-arm the timer of a session whose length changed
+            self.cancel_charge(next_interval)
+
+        self._charge_session = (start, session_end)
+        duration = int((session_end - next_interval).total_seconds() // 60)
+        self.update_charge_timers([next_interval], duration)
+
+    def stop_charge_session(self, at: datetime) -> None:
+        start, end = self._charge_session
+        self._charge_session = (start, at)
+        stop_script = self.args.get("charge_stop_script")
+        if not stop_script:
+            self.log(f"No charge_stop_script configured, charge session will run until {end.strftime('%Y-%m-%d %H:%M')}")
+            return
+        self.log(f"Stopping charge session at {at.strftime('%Y-%m-%d %H:%M')}")
+        self._charge_timers[at] = self.run_at(self.stop_charging, at, slot=at)
 
-    def schedule_charge(self, target_time: datetime) -> None:
+    def update_charge_timers(self, charge_slots: List[datetime], duration: Optional[int] = None) -> None:
+        now = datetime.now()
+        wanted = {slot.replace(second=0, microsecond=0) for slot in charge_slots}
+        for slot in list(self._charge_timers):
+            if slot < now:
+                # Already fired
+                del self._charge_timers[slot]
+            elif slot not in wanted:
+                self.cancel_charge(slot)
+        for slot in sorted(wanted):
+            self.schedule_charge(slot, duration)
+
+    def get_charge_timers(self) -> Dict[datetime, str]:
+        return dict(sorted(self._charge_timers.items()))
+
+    def schedule_charge(self, target_time: datetime, duration: Optional[int] = None) -> None:
         now = datetime.now()
         target = target_time.replace(second=0, microsecond=0)
         if target < now:
             return
+        if target in self._charge_timers:
+            self.log(f"Charging already scheduled: {target.strftime('%Y-%m-%d %H:%M')}")
+            return
         self.log(f"Next charging scheduled: {target.strftime('%Y-%m-%d %H:%M')}")
-        self.run_at(self.start_charging, target, hour=target.hour, minute=target.minute)
+        timer_kwargs = {"hour": target.hour, "minute": target.minute, "slot": target}
+        if duration is not None:
+            timer_kwargs["duration"] = duration
+        self._charge_timers[target] = self.run_at(self.start_charging, target, **timer_kwargs)
+
+    def cancel_charge(self, target_time: datetime) -> None:
+        handle = self._charge_timers.pop(target_time, None)
+        if handle is not None:
+            self.log(f"Cancelling scheduled charging: {target_time.strftime('%Y-%m-%d %H:%M')}")
+            self.cancel_timer(handle, silent=True)
 
     def start_charging(self, kwargs: Dict[str, Any]) -> None:
+        with self._planning_lock:
+            self._charge_timers.pop(kwargs.get("slot"), None)
         hour = kwargs.get("hour")
         minute = kwargs.get("minute")
-        duration = self.args.get("charge_duration_minutes", 15)  # Default to 15 minutes if not specified
+        # Session length if the charge was scheduled as a session, otherwise the configured duration
+        duration = kwargs.get("duration") or self.args.get("charge_duration_minutes", 15)  # Default to 15 minutes if not specified
         power = self.args.get("charge_power_w", 3000)
 
         self.log(f"Starting CHARGE at {hour:02d}:{minute:02d} for {duration} minutes at {power}W")
 
-        self.call_service("script/turn_on", entity_id="script.force_battery_charge", variables={
+        self.call_service("script/turn_on", entity_id=self.args.get("charge_script", "script.force_battery_charge"), variables={
             "duration": duration,
             "power": power
         })
+        with self._planning_lock:
+            self.save_cache()
+
+    def stop_charging(self, kwargs: Dict[str, Any]) -> None:
+        with self._planning_lock:
+            self._charge_timers.pop(kwargs.get("slot"), None)
+        stop_script = self.args["charge_stop_script"]
+        self.log(f"Stopping CHARGE using {stop_script}")
+        self.call_service("script/turn_on", entity_id=stop_script)
+        with self._planning_lock:
+            self.save_cache()
+
+
+class FleetBattery(SmartBatteryManager):
+    """One battery of a fleet, planned by the fleet app with its own arguments and timers."""
+
+    def __init__(self, fleet: SmartBatteryManager, name: str, args: Dict[str, Any], stagger_seconds: float) -> None:
+        # Runs inside the fleet app, which owns the AppDaemon connection
+        self.fleet = fleet
+        self.name = name
+        self.args = args
+        self.stagger = timedelta(seconds=stagger_seconds)
+        self.init_planner_state()
+
+    def log(self, msg: str, *args: Any, **kwargs: Any) -> None:
+        self.fleet.log(f"[{self.name}] {msg}", *args, **kwargs)
+
+    def get_state(self, *args: Any, **kwargs: Any) -> Any:
+        self._stats.count("get_state")
+        return self.fleet.get_state(*args, **kwargs)
+
+    def get_price_snapshot(self) -> Optional[PriceSnapshot]:
+        # Prices and their candidates are parsed once by the fleet and shared by all batteries
+        return self.fleet.get_price_snapshot()
+
+    def get_slot_start(self, when: datetime) -> datetime:
+        # The fleet holds the price snapshot, the battery never parses its own
+        return self.fleet.get_slot_start(when)
+
+    def set_state(self, *args: Any, **kwargs: Any) -> Any:
+        return self.fleet.set_state(*args, **kwargs)
+
+    def run_at(self, callback: Any, start: datetime, **kwargs: Any) -> Any:
+        # Offset every battery's timers so the sites do not all call their scripts at the same moment
+        return self.fleet.run_at(callback, start + self.stagger, **kwargs)
+
+    def run_in(self, callback: Any, delay: float, **kwargs: Any) -> Any:
+        return self.fleet.run_in(callback, delay, **kwargs)
+
+    def cancel_timer(self, handle: Any, *args: Any, **kwargs: Any) -> Any:
+        return self.fleet.cancel_timer(handle, *args, **kwargs)
+
+    def call_service(self, *args: Any, **kwargs: Any) -> Any:
+        return self.fleet.call_service(*args, **kwargs)
@@ -0,0 +1,108 @@
+import pytest
+from datetime import datetime, timedelta
+from backtest import BatteryModel, Dataset, ReplayApp, SimulatedClock, StateStore, param_grid, publish_inputs, run_backtest, run_sweep
+
+START = datetime(2025, 5, 1)
+
+def make_dataset(days=2):
+    # A cheap block from 02:00 to 05:00 every night with its minimum at 03:00
+    night = {2: 0.3, 3: 0.2, 4: 0.3}
+    prices = [
+        {"startsAt": (START + timedelta(hours=h)).isoformat() + "+02:00", "total": night.get(h % 24, 1.0)}
+        for h in range(24 * days)
+    ]
+    return Dataset(START, prices, [0.0] * (96 * days), [0.1] * (96 * days), initial_soc=0.2)
+
+def test_state_store_tracks_updates():
+    clock = SimulatedClock(START)
+    store = StateStore(clock)
+    store.set("sensor.tibber", "ok", {"today": [1]})
+    first = store.get("sensor.tibber", attribute="last_updated")
+
+    clock.now = START + timedelta(minutes=15)
+    store.set("sensor.tibber", "ok", {"today": [1]})
+    assert store.get("sensor.tibber", attribute="last_updated") == first
+
+    store.set("sensor.tibber", "ok", {"today": [2]})
+    assert store.get("sensor.tibber", attribute="last_updated") != first
+    assert store.get("sensor.tibber", attribute="today") == [2]
+    assert store.get("sensor.tibber") == "ok"
+
+def test_battery_model_charges_and_discharges():
+    battery = BatteryModel(10, 0.5)
+    battery.start_charge(START, 30, 4000)
+    flows = battery.step(START, solar_kwh=0.0, load_kwh=0.5)
+    assert flows["charge_kwh"] == pytest.approx(1.0)
+    assert battery.soc == pytest.approx(0.55)
+
+    battery.step(START + timedelta(minutes=15), 0.0, 0.0)
+    flows = battery.step(START + timedelta(minutes=30), solar_kwh=0.0, load_kwh=0.5)
+    assert flows["charge_kwh"] == 0.0
+    assert battery.soc == pytest.approx(0.6)
+
+def test_simulated_clock_patches_planner_time():
+    import smart_battery
+    clock = SimulatedClock(START)
+    with clock.patch():
+        assert smart_battery.datetime.now() == START
+    assert smart_battery.datetime.now() != START
+
+def test_publish_inputs_uses_configured_solar_arrays():
+    dataset = make_dataset(days=1)
+    dataset.solar_kwh[40:48] = [0.5] * 8
+    store = StateStore(SimulatedClock(START + timedelta(hours=9, minutes=59)))
+    args = {"soc_sensor": "sensor.soc", "tibber_sensor": "sensor.tibber"}
+    solar_arrays = [
+        {"energy_next_hour": "sensor.next_hour", "energy_today_remaining": "sensor.remaining"},
+        {"energy_today_remaining": "sensor.remaining_2"},
+    ]
+    publish_inputs(store, args, solar_arrays, dataset, 40, START + timedelta(hours=10), BatteryModel(10, 0.5), 13)
+
+    assert store.get("sensor.next_hour") == "2.000"
+    assert store.get("sensor.remaining") == "4.000"
+    assert store.get("sensor.remaining_2") == "0.000"
+
+def test_run_backtest_charges_in_cheap_hours():
+    args = {"soc_targets": [0.9] * 24, "always_charge_factor": 0.1, "charge_power_w": 3000}
+    result = run_backtest(make_dataset(), args)
+
+    assert result["days"] == 2
+    assert result["charge_kwh"] > 0
+    # Each cheap block becomes a single charge session
+    assert result["service_calls"] == 2
+    # All grid energy went into the battery during the cheap block
+    assert result["grid_kwh"] == pytest.approx(result["charge_kwh"])
+    assert 0.2 * result["grid_kwh"] <= result["cost"] <= 0.3 * result["grid_kwh"]
+
+def test_replay_does_not_publish_planner_sensors():
+    dataset = make_dataset(days=1)
+    clock = SimulatedClock(START + timedelta(hours=1, minutes=59))
+    store = StateStore(clock)
+    args = {"soc_sensor": "sensor.soc", "tibber_sensor": "sensor.tibber", "always_charge_factor": 0.1}
+    app = ReplayApp(args, clock, store, BatteryModel(10, 0.2))
+    publish_inputs(store, args, [], dataset, 8, START + timedelta(hours=2), app.battery, 13)
+    with clock.patch():
+        app.plan_charging({})
+    assert app._stats.decision == "charge"
+    assert app._horizon_plan is None
+    assert sorted(store.entities) == ["sensor.soc", "sensor.tibber"]
+
+def test_run_backtest_counts_quarter_hour_target_misses():
+    args = {"always_charge_factor": 0.1, "charge_power_w": 3000}
+    assert run_backtest(make_dataset(days=1), {**args, "soc_targets": [0.0] * 96})["target_misses"] == 0
+    # Only the last quarter hour of the day asks for a full battery
+    result = run_backtest(make_dataset(days=1), {**args, "soc_targets": [0.0] * 95 + [1.0]})
+    assert result["target_misses"] == 1
+
+def test_param_grid():
+    configs = param_grid({"charge_power_w": 3000}, always_charge_factor=[0.1, 0.2], planner=["heuristic", "optimal"])
+    assert len(configs) == 4
+    assert all(c["charge_power_w"] == 3000 for c in configs)
+    assert {"always_charge_factor": 0.2, "planner": "optimal", "charge_power_w": 3000} in configs
+
+def test_run_sweep_matches_single_runs():
+    dataset = make_dataset(days=1)
+    configs = param_grid({"soc_targets": [0.9] * 24}, always_charge_factor=[0.1, 0.5])
+    results = run_sweep(dataset, configs, processes=2)
+    assert [r["args"] for r in results] == configs
+    assert results[0]["cost"] == pytest.approx(run_backtest(dataset, configs[0])["cost"])
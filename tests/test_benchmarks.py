@@ -0,0 +1,17 @@
+from benchmarks import bench_planning
+from benchmarks.synthetic import HORIZONS, tibber_attributes, tibber_entries
+
+def test_synthetic_payloads_are_deterministic():
+    for horizon, (slots, minutes) in HORIZONS.items():
+        entries = tibber_entries(slots, minutes, "volatile")
+        assert len(entries) == slots
+        assert entries == tibber_entries(slots, minutes, "volatile")
+    attributes = tibber_attributes(tibber_entries(48, 60, "flat"))
+    assert len(attributes["today"]) == 24 and len(attributes["tomorrow"]) == 24
+
+def test_benchmark_suite_smoke():
+    results = bench_planning.run(repeat=1, only="/48/")
+    assert len(results) == 18
+    assert results["run_backtest[day]/48/volatile"]["median_us"] > 0
+    assert results["get_price_for_interval/48/flat"]["get_state_calls"] >= 1
+    assert bench_planning.report(results, {}) == []
@@ -0,0 +1,65 @@
+import sqlite3
+import pytest
+from datetime import datetime, timedelta
+from load_profile import LoadProfile
+
+START = datetime(2025, 5, 5)  # A Monday
+
+def make_db(path, hours, has_sum=True):
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE statistics_meta (id INTEGER PRIMARY KEY, statistic_id TEXT, has_mean INTEGER, has_sum INTEGER)")
+    connection.execute("CREATE TABLE statistics (id INTEGER PRIMARY KEY, metadata_id INTEGER, start_ts REAL, mean REAL, sum REAL)")
+    connection.execute("INSERT INTO statistics_meta VALUES (1, 'sensor.other', 0, 1)")
+    connection.execute("INSERT INTO statistics_meta VALUES (2, 'sensor.house_energy', ?, ?)", (int(not has_sum), int(has_sum)))
+    add_hours(connection, 0, hours)
+    return connection
+
+def hourly_load(hour):
+    # 2 kWh in the evening peak, 0.5 kWh otherwise
+    return 2.0 if 17 <= hour % 24 < 20 else 0.5
+
+def add_hours(connection, first, last):
+    total = sum(hourly_load(h) for h in range(first))
+    for h in range(first, last):
+        start = START + timedelta(hours=h)
+        total += hourly_load(h)
+        connection.execute(
+            "INSERT INTO statistics (metadata_id, start_ts, mean, sum) VALUES (2, ?, ?, ?)",
+            (start.timestamp(), hourly_load(h) * 1000, total),
+        )
+        connection.execute("INSERT INTO statistics (metadata_id, start_ts, mean, sum) VALUES (1, ?, 0, 0)", (start.timestamp(),))
+    connection.commit()
+
+def test_profile_from_sum_statistics(tmp_path):
+    db = tmp_path / "home-assistant_v2.db"
+    connection = make_db(db, 24 * 7)
+    profile = LoadProfile(str(db), "sensor.house_energy")
+
+    now = (START + timedelta(days=7, hours=1)).timestamp()
+    assert profile.update(now) == 24 * 7
+    # The first row only sets the starting point of the sum, that hour falls back to the average
+    assert profile.hourly_kwh(START + timedelta(days=7)) == pytest.approx((21 * 2.0 + 146 * 0.5) / 167)
+    assert profile.hourly_kwh(START + timedelta(days=1, hours=18)) == pytest.approx(2.0)
+    assert profile.energy_between(START + timedelta(hours=16, minutes=30), START + timedelta(hours=18)) == pytest.approx(2.25)
+    assert profile.slot_energy([START + timedelta(hours=17)], timedelta(minutes=15)).tolist() == [0.5]
+
+    # Only rows written since the last update are read
+    add_hours(connection, 24 * 7, 24 * 7 + 3)
+    assert profile.update(now + 60) == 0
+    assert profile.update(now + 3 * 3600) == 3
+    assert profile.hourly_kwh(START + timedelta(days=7)) == pytest.approx(0.5)
+
+def test_profile_from_mean_statistics(tmp_path):
+    db = tmp_path / "home-assistant_v2.db"
+    make_db(db, 24, has_sum=False)
+    profile = LoadProfile(str(db), "sensor.house_energy")
+    assert profile.update((START + timedelta(days=1)).timestamp()) == 24
+    assert profile.hourly_kwh(START + timedelta(hours=18)) == pytest.approx(2.0)
+
+def test_profile_is_read_only(tmp_path):
+    db = tmp_path / "home-assistant_v2.db"
+    make_db(db, 1).close()
+    with pytest.raises(sqlite3.OperationalError):
+        LoadProfile(str(db), "sensor.house_energy").connect().execute("DELETE FROM statistics")
+    with pytest.raises(ValueError):
+        LoadProfile(str(db), "sensor.missing").update()
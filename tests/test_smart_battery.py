@@ -1,10 +1,19 @@
+import asyncio
+import json
+import threading
+import time
 import pytest
-from unittest.mock import MagicMock, patch
+from unittest.mock import AsyncMock, MagicMock, patch
 from datetime import datetime, timedelta
-from smart_battery import SmartBatteryManager
+import numpy as np
+from load_profile import LoadProfile
+from smart_battery import SmartBatteryManager, HorizonPlan, PriceSnapshot, SlotSeries, StateSnapshot, candidate_mask, local_minima_mask, optimal_charge_mask, parse_price_entries, project_soc, PriceSmoother, ema_prices, smooth_prices, solar_forecast_periods, align_energy
 
 @pytest.fixture
 def app():
+    return make_app()
+
+def make_app():
     # Mock the required arguments for Hass.__init__()
     ad = MagicMock()
     name = "smart_battery"
@@ -29,7 +38,11 @@ def app():
     app.get_state = MagicMock()
     app.log = MagicMock()
     app.run_at = MagicMock()
+    app.run_in = MagicMock()
+    app.cancel_timer = MagicMock()
+    app.listen_state = MagicMock()
     app.call_service = MagicMock()
+    app.set_state = MagicMock()
     return app
 
 def test_schedule_charge(app):
@@ -99,6 +112,29 @@ def test_calculate_energy_needed(app):
     energy_needed = app.calculate_energy_needed(soc, target_soc)
     assert energy_needed == pytest.approx(3.0)  # (0.8 - 0.5) * 10
 
+def test_expected_load_is_subtracted(app):
+    profile = LoadProfile("unused.db", "sensor.house_energy")
+    profile.kwh[:] = 1.0
+    profile.update = MagicMock(return_value=0)
+    app._load_profile = profile
+    app.args["load_statistic"] = "sensor.house_energy"
+    app.get_solar_next_hour = MagicMock(return_value=1.4)
+    app.get_solar_remaining = MagicMock(return_value=0.0)
+
+    with patch("smart_battery.datetime") as mock_datetime:
+        mock_datetime.now.return_value = datetime(2025, 5, 1, 10, 0)
+        mock_datetime.strptime = datetime.strptime
+        # One hour of load on top of the energy to reach the target
+        assert app.calculate_energy_needed(0.5, 0.55) == pytest.approx(1.5)
+        # The next hour's solar is enough for the target, but not once the load is taken off
+        assert not app.check_skip_charge(0.5, 0.55, 1.5)
+
+    charge, projected = project_soc(
+        np.array([False, True]), np.full(2, 0.5), np.zeros(2), 0.5, 10, 1.0, load_kwh=np.full(2, 1.0)
+    )
+    assert charge.tolist() == [False, True]
+    assert projected == pytest.approx([0.4, 0.4])
+
 def test_get_solar_next_hour(app):
     # Mock solar sensor states
     app.get_state.side_effect = ["2.5", "1.5"]
@@ -200,4 +236,1013 @@ def test_check_skip_charge_projected_soc(app):
         app.args["battery_capacity_kwh"] = 10
         skip = app.check_skip_charge(soc, target_soc, energy_needed)
         assert skip is True
-        app.log.assert_any_call("Skipping charge: Expected solar next hour is enough to reach SoC target")
\ No newline at end of file
+        app.log.assert_any_call("Skipping charge: Expected solar next hour is enough to reach SoC target")
+
+def tibber_state(prices, start=datetime(2025, 5, 1, 0, 0), last_updated="2025-05-01T13:00:00+00:00"):
+    entries = [
+        {"startsAt": (start + timedelta(hours=i)).isoformat() + "+02:00", "total": price}
+        for i, price in enumerate(prices)
+    ]
+    return {
+        "state": str(prices[0]),
+        "last_updated": last_updated,
+        "attributes": {"today": entries[:24], "tomorrow": entries[24:]},
+    }
+
+def mock_tibber(app, state):
+    app.args["tibber_sensor"] = "sensor.tibber"
+    app.get_state.side_effect = lambda entity, attribute=None, **kwargs: (
+        state if attribute == "all" else state.get(attribute) if attribute else state["state"]
+    )
+
+def test_price_snapshot_parsed_once_per_update(app):
+    state = tibber_state([1.0, 0.5, 2.0])
+    mock_tibber(app, state)
+
+    with patch("smart_battery.PriceSnapshot", wraps=PriceSnapshot) as snapshot_cls:
+        app.get_all_prices()
+        app.get_price_for_interval(datetime(2025, 5, 1, 1, 15))
+        app.get_candidate_hours()
+        assert snapshot_cls.call_count == 1
+
+        state["last_updated"] = "2025-05-01T14:00:00+00:00"
+        app.get_all_prices()
+        assert snapshot_cls.call_count == 2
+
+def test_price_snapshot_reuses_unchanged_price_blocks(app):
+    state = tibber_state([1.0] * 24)
+    mock_tibber(app, state)
+    assert len(app.get_price_snapshot()) == 24
+
+    # Tomorrow's prices land, today's block is not parsed again
+    state.update(tibber_state([1.0] * 24 + [0.5] * 24, last_updated="2025-05-01T14:00:00+00:00"))
+    with patch("smart_battery.parse_price_entries", wraps=parse_price_entries) as parse:
+        snapshot = app.get_price_snapshot()
+    assert len(snapshot) == 48
+    assert parse.call_count == 1
+    assert parse.call_args.args[0] == state["attributes"]["tomorrow"]
+    assert app._stats.counters["price_block_reused"] == 1
+
+def test_price_snapshot_lookup_and_mean():
+    snapshot = PriceSnapshot("key", tibber_state([3.0, 1.0, 2.0])["attributes"]["today"])
+    assert snapshot.interval == timedelta(hours=1)
+    assert snapshot.price_at(datetime(2025, 5, 1, 1, 0)) == 1.0
+    assert snapshot.price_at(datetime(2025, 5, 1, 1, 45)) == 1.0
+    assert snapshot.price_at(datetime(2025, 5, 1, 3, 0)) is None
+    assert snapshot.price_at(datetime(2025, 4, 30, 23, 0)) is None
+    assert snapshot.mean == pytest.approx(2.0)
+    assert snapshot.future_mean(datetime(2025, 5, 1, 0, 30)) == pytest.approx(1.5)
+    assert snapshot.future_mean(datetime(2025, 5, 1, 3, 0)) is None
+
+def test_price_snapshot_across_dst_changes():
+    # Clocks go back at 03:00 on 2025-10-26, 02:00-03:00 local time happens twice
+    autumn = PriceSnapshot("key", [
+        {"startsAt": t, "total": p} for t, p in [
+            ("2025-10-26T01:00:00+02:00", 1.0), ("2025-10-26T02:00:00+02:00", 2.0),
+            ("2025-10-26T02:00:00+01:00", 3.0), ("2025-10-26T03:00:00+01:00", 4.0),
+        ]
+    ])
+    assert autumn.interval == timedelta(hours=1)
+    assert autumn.times == [datetime(2025, 10, 26, h) for h in (1, 2, 2, 3)]
+    assert autumn.price_at(datetime(2025, 10, 26, 2, 30)) == 2.0
+    assert autumn.price_at(datetime(2025, 10, 26, 3, 15)) == 4.0
+    assert autumn.future_mean(datetime(2025, 10, 26, 3, 0)) == pytest.approx(4.0)
+
+    # Clocks go forward at 02:00 on 2025-03-30, the next slot after 01:00 starts at 03:00
+    spring = PriceSnapshot("key", [
+        {"startsAt": t, "total": p} for t, p in [
+            ("2025-03-30T01:00:00+01:00", 1.0), ("2025-03-30T03:00:00+02:00", 2.0), ("2025-03-30T04:00:00+02:00", 3.0),
+        ]
+    ])
+    assert spring.interval == timedelta(hours=1)
+    assert spring.price_at(datetime(2025, 3, 30, 1, 45)) == 1.0
+    assert spring.price_at(datetime(2025, 3, 30, 3, 30)) == 2.0
+    assert spring.series.containing(datetime(2025, 3, 30, 4, 0)) == 2
+
+def test_slot_series_with_gaps():
+    series = SlotSeries([datetime(2025, 5, 1, 0, 0), datetime(2025, 5, 1, 0, 15), datetime(2025, 5, 1, 1, 0)], np.zeros(3))
+    assert series.interval == timedelta(minutes=15)
+    assert series.index(datetime(2025, 5, 1, 0, 20)) == 1
+    assert series.index(datetime(2025, 5, 1, 0, 30)) is None
+    assert series.index(datetime(2025, 5, 1, 1, 14)) == 2
+    assert series.index(datetime(2025, 5, 1, 1, 15)) is None
+
+def test_mixed_hourly_and_quarter_hour_blocks(app):
+    # Hourly prices today with a cheap hour at 02:00, quarter hour prices tomorrow
+    today = [{"startsAt": f"2025-05-01T{h:02d}:00:00+02:00", "total": 0.2 if h == 2 else 1.0} for h in range(24)]
+    tomorrow = [
+        {"startsAt": (datetime(2025, 5, 2) + timedelta(minutes=15 * i)).isoformat() + "+02:00", "total": 1.0}
+        for i in range(96)
+    ]
+    mock_tibber(app, {"state": "1.0", "last_updated": "key", "attributes": {"today": today, "tomorrow": tomorrow}})
+    snapshot = app.get_price_snapshot()
+    series = snapshot.series
+    assert snapshot.interval == timedelta(minutes=15)
+    assert series.durations.tolist() == [3600.0] * 24 + [900.0] * 96
+    assert series.index(datetime(2025, 5, 1, 5, 30)) == 5
+    assert series.index(datetime(2025, 5, 1, 23, 59)) == 23
+    assert series.index(datetime(2025, 5, 2, 0, 20)) == 25
+    assert app.get_price_for_interval(datetime(2025, 5, 1, 2, 45)) == 0.2
+
+    # Every quarter hour of the cheap hour belongs to its slot
+    candidates = [datetime(2025, 5, 1, 2, 0)]
+    assert app.get_slot_start(datetime(2025, 5, 1, 2, 30)) == datetime(2025, 5, 1, 2, 0)
+    assert app.is_next_interval_candidate(datetime(2025, 5, 1, 2, 15), candidates)
+    assert app.build_charge_session(datetime(2025, 5, 1, 2, 15), candidates) == datetime(2025, 5, 1, 3, 0)
+
+    # A plan across both blocks reports the length of every slot and ends its windows with the slot
+    plan = HorizonPlan("key", snapshot.times[23:26], series.durations[23:26], snapshot.prices[23:26],
+                       np.array([True, True, False]), np.zeros(3, dtype=bool), np.zeros(3), np.zeros(3))
+    attributes = plan.attributes()
+    assert attributes["interval_minutes"] == [60, 15, 15]
+    assert attributes["candidate_windows"] == [["2025-05-01T23:00:00", "2025-05-02T00:15:00"]]
+
+def test_always_charge_without_a_price_for_the_next_interval(app):
+    mock_tibber(app, tibber_state([1.0, 0.5, 1.0]))
+    app.args["always_charge_factor"] = 0.5
+    with patch("smart_battery.datetime") as mock_datetime:
+        mock_datetime.now.return_value = datetime(2025, 5, 1, 0, 0)
+        assert not app.check_always_charge(datetime(2025, 5, 1, 5, 0))
+    app.log.assert_any_call("No price found for interval: 2025-05-01 05:00:00")
+
+def test_quarter_hour_prices_and_targets(app):
+    prices = [1.0] * 96
+    prices[9:11] = [0.2, 0.3]  # 02:15 and 02:30
+    start = datetime(2025, 5, 1)
+    mock_tibber(app, {"state": "1.0", "last_updated": "key", "attributes": {"today": [
+        {"startsAt": (start + timedelta(minutes=15 * i)).isoformat() + "+02:00", "total": p} for i, p in enumerate(prices)
+    ]}})
+    # Without smoothing, a single quarter-hour dip is a minimum of its own
+    app.args["smoothing_window_minutes"] = 15
+    candidates = app.get_candidate_hours()
+    assert candidates == [datetime(2025, 5, 1, 2, 15), datetime(2025, 5, 1, 2, 30)]
+    assert not app.is_next_interval_candidate(datetime(2025, 5, 1, 2, 0), candidates)
+    assert app.is_next_interval_candidate(datetime(2025, 5, 1, 2, 15), candidates)
+    assert app.build_charge_session(datetime(2025, 5, 1, 2, 15), candidates) == datetime(2025, 5, 1, 2, 45)
+    assert app.get_price_for_interval(datetime(2025, 5, 1, 2, 30)) == 0.3
+
+    app.args["soc_targets"] = [0.3] * 9 + [0.8] + [0.3] * 86
+    assert app.get_target_soc(datetime(2025, 5, 1, 2, 15)) == 0.8
+    assert app.get_target_soc(datetime(2025, 5, 1, 2, 30)) == 0.3
+    app.log.assert_called_with("Selected target battery SoC for 02:30: 30%")
+
+def reference_candidate_hours(all_prices):
+    # The original scan-based implementation, kept to check the vectorized engine against
+    local_minima = [
+        all_prices[i][0] for i in range(1, len(all_prices) - 1)
+        if all_prices[i][1] < all_prices[i - 1][1] and all_prices[i][1] < all_prices[i + 1][1]
+    ]
+    mean_price = sum(p[1] for p in all_prices) / len(all_prices)
+    candidate_hours = set()
+    for minimum in local_minima:
+        min_price = next(p for (t, p) in all_prices if t == minimum)
+        candidate_hours.add(minimum)
+        for t, p in reversed(all_prices):
+            if t < minimum and p <= min_price + 0.10 and p < mean_price:
+                candidate_hours.add(t)
+            elif t < minimum:
+                break
+        for t, p in all_prices:
+            if t > minimum and p <= min_price + 0.10 and p < mean_price:
+                candidate_hours.add(t)
+            elif t > minimum:
+                break
+    return sorted(candidate_hours)
+
+@pytest.mark.parametrize("seed", range(50))
+def test_candidate_engine_matches_reference(app, seed):
+    rng = np.random.default_rng(seed)
+    n = int(rng.integers(1, 200))
+    start = datetime(2025, 5, 1)
+    # Rounded prices give plenty of ties and plateaus
+    prices = np.round(rng.uniform(0.0, 1.5, n), 1 if seed % 2 else 2)
+    all_prices = [(start + timedelta(minutes=15 * i), float(p)) for i, p in enumerate(prices)]
+
+    minima = app.find_local_minima(all_prices)
+    assert app.build_candidate_hours(minima, all_prices) == reference_candidate_hours(all_prices)
+
+def test_candidate_engine_long_horizon():
+    rng = np.random.default_rng(1)
+    prices = rng.uniform(0.0, 2.0, 5000)
+    mask = candidate_mask(prices)
+    assert mask.shape == (5000,)
+    assert mask[local_minima_mask(prices)].all()
+
+@pytest.mark.parametrize("method, window", [("mean", 3), ("mean", 12), ("median", 4), ("median", 1)])
+def test_smooth_prices_matches_reference(method, window):
+    prices = np.random.default_rng(window).uniform(0.0, 2.0, 50)
+    half = window // 2
+    padded = np.pad(prices, (half, window - 1 - half), mode="edge")
+    reduce = np.mean if method == "mean" else np.median
+    reference = np.array([reduce(padded[i:i + window]) for i in range(len(prices))])
+    assert smooth_prices(prices, window, method) == pytest.approx(reference)
+    assert smooth_prices(prices, window, method, 10, 20) == pytest.approx(reference[10:20])
+
+@pytest.mark.parametrize("method", PriceSmoother.methods)
+def test_price_smoother_updates_incrementally(method):
+    prices = np.random.default_rng(0).uniform(0.0, 2.0, 192)
+    keys = np.arange(192) * 900.0
+    full = PriceSmoother(method, 12).update(keys, prices)
+
+    smoother = PriceSmoother(method, 12)
+    smoother.update(keys[:96], prices[:96])
+    # Tomorrow's prices are appended
+    assert smoother.update(keys, prices) == pytest.approx(full)
+    assert smoother.recomputed < 96 + 12
+    assert smoother.update(keys, prices) is smoother.smoothed
+    assert smoother.recomputed == 0
+
+    # Yesterday's prices are dropped at midnight, the result does not depend on what was seen before
+    tail = smoother.update(keys[96:], prices[96:])
+    assert tail == pytest.approx(PriceSmoother(method, 12).update(keys[96:], prices[96:]))
+    # The EMA is seeded again from the new first price, mean and median only redo the edges
+    if method == "ema":
+        assert smoother.recomputed == 96
+    else:
+        assert smoother.recomputed <= 12
+
+def test_smoothing_removes_spurious_minima(app):
+    # One cheap night with a small wiggle in the expensive evening
+    prices = [1.0, 0.8, 0.4, 0.3, 0.4, 0.8, 1.0, 1.2, 1.3, 1.25, 1.3, 1.2] * 2
+    mock_tibber(app, tibber_state(prices))
+    assert app.get_candidate_hours() == [datetime(2025, 5, 1, h, 0) for h in (2, 3, 4, 14, 15, 16)]
+
+    app.args["smoothing_window_minutes"] = 60
+    app._price_snapshot = None
+    raw = app.get_candidate_hours()
+    assert datetime(2025, 5, 1, 9, 0) in raw
+
+    app.args["smoothing_method"] = "unknown"
+    app._price_snapshot = None
+    with pytest.raises(ValueError):
+        app.get_candidate_hours()
+
+def test_optimal_planner_waits_for_cheaper_slot():
+    # A local dip at slot 1 and a cheaper slot at 4, one charge slot is enough to reach the target
+    prices = np.array([1.0, 0.5, 1.0, 0.8, 0.2, 1.0])
+    targets = np.array([0.0, 0.0, 0.0, 0.0, 0.0, 0.8])
+    mask = optimal_charge_mask(prices, targets, np.zeros(6), 0.5, 10, 3.0, soc_steps=100)
+    assert mask.tolist() == [False, False, False, False, True, False]
+
+def test_optimal_planner_matches_brute_force():
+    rng = np.random.default_rng(3)
+    prices = np.round(rng.uniform(0.0, 2.0, 8), 2)
+    targets = np.array([0.3, 0.3, 0.5, 0.5, 0.5, 0.9, 0.9, 0.5])
+    solar = np.array([0, 0, 0, 0.5, 1.0, 0, 0, 0])
+    mask = optimal_charge_mask(prices, targets, solar, 0.2, 10, 2.0, soc_steps=100, shortfall_penalty=100)
+
+    def cost(plan):
+        soc, total = 0.2 * 10, 0.0
+        for price, target, sun, charge in zip(prices, targets, solar, plan):
+            before = min(soc + sun, 10)
+            soc = min(before + (2.0 if charge else 0), 10)
+            total += (soc - before) * price + max(target * 10 - soc, 0) * 100
+        return total
+
+    plans = [[bool(b >> i & 1) for i in range(8)] for b in range(256)]
+    assert cost(mask.tolist()) == pytest.approx(min(cost(p) for p in plans))
+
+def test_plan_charging_optimal_mode(app):
+    app.args.update({"planner": "optimal", "charge_power_w": 3000})
+    app.get_current_soc = MagicMock(return_value=0.5)
+    app.check_always_charge = MagicMock(return_value=False)
+    app.get_solar_next_hour = MagicMock(return_value=0.0)
+    app.get_optimal_charge_slots = MagicMock(return_value=[datetime(2025, 5, 1, 2, 0)])
+    app.schedule_charge = MagicMock()
+
+    with patch("smart_battery.datetime") as mock_datetime:
+        mock_datetime.now.return_value = datetime(2025, 5, 1, 1, 59)
+        app.plan_charging({})
+    # The hourly slot becomes one 60 minute session
+    app.schedule_charge.assert_called_once_with(datetime(2025, 5, 1, 2, 0), 60)
+
+def test_initialize_listens_to_inputs(app):
+    app.args["tibber_sensor"] = "sensor.tibber"
+    app.run_every = MagicMock()
+    app.initialize()
+
+    app.listen_state.assert_any_call(app.on_input_change, "sensor.battery_soc")
+    app.listen_state.assert_any_call(app.on_input_change, "sensor.tibber", attribute="all")
+    app.listen_state.assert_any_call(app.on_input_change, "sensor.solar_remaining_2")
+    assert app.listen_state.call_count == 6
+
+def test_input_changes_are_debounced(app):
+    app.run_in.side_effect = ["handle-1", "handle-2"]
+    app.on_input_change("sensor.battery_soc", "state", "50", "51", {})
+    app.on_input_change("sensor.solar_next_hour_1", "state", "1.0", "1.2", {})
+    app.on_input_change("sensor.solar_next_hour_2", "state", "0.5", "0.5", {})
+
+    assert app.run_in.call_count == 2
+    app.cancel_timer.assert_called_once_with("handle-1", silent=True)
+    assert app._replan_handle == "handle-2"
+
+def mock_states(app, states):
+    # get_state for single entities and for the bulk read of a whole domain
+    entities = {entity: {"state": state, "attributes": {}} for entity, state in states.items()}
+
+    def get_state(entity, attribute=None, **kwargs):
+        if "." not in entity:
+            return {k: v for k, v in entities.items() if k.startswith(entity + ".")}
+        return entities.get(entity, {}).get("state")
+
+    app.get_state.side_effect = get_state
+
+def test_plan_charging_skips_unchanged_inputs(app):
+    mock_states(app, {"sensor.battery_soc": "60", "sensor.solar_next_hour_1": "1.0"})
+    app.check_always_charge = MagicMock(return_value=True)
+    app.get_always_charge_slots = MagicMock(return_value=[datetime(2025, 5, 1, 2, 0)])
+
+    with patch("smart_battery.datetime") as mock_datetime:
+        mock_datetime.now.return_value = datetime(2025, 5, 1, 1, 59)
+        app.plan_charging({})
+        app.plan_charging({})
+        assert app.check_always_charge.call_count == 1
+        app.log.assert_any_call("Planning inputs unchanged, using the cached charge plan")
+        assert app._stats.decision == "unchanged"
+
+        # The next interval is not an always charge slot, the regular checks have to run
+        mock_datetime.now.return_value = datetime(2025, 5, 1, 3, 14)
+        app.plan_charging({})
+        assert app.check_always_charge.call_count == 2
+
+def test_ticks_use_the_cached_charge_plan(app):
+    clock = session_app(app, datetime(2025, 5, 1, 1, 44))
+    try:
+        app.get_candidate_hours = MagicMock(return_value=[datetime(2025, 5, 1, h, 0) for h in (2, 3)])
+        mock_states(app, {"sensor.battery_soc": "50"})
+        app.plan_charging({})
+        assert app._stats.decision == "not_candidate"
+        app.run_at.assert_not_called()
+
+        # The following ticks only look up the next interval in the cached plan
+        clock.now.return_value = datetime(2025, 5, 1, 1, 59)
+        app.plan_charging({})
+        assert app._stats.decision == "unchanged"
+        assert app.run_at.call_args.kwargs["duration"] == 120
+        clock.now.return_value = datetime(2025, 5, 1, 2, 14)
+        app.plan_charging({})
+        assert app.get_candidate_hours.call_count == 1
+        assert app.check_skip_charge.call_count == 1
+        app.run_at.assert_called_once()
+
+        # A changed input or SoC target runs the full pipeline again
+        app.args["soc_targets"] = [0.5] * 3 + [0.8] * 21
+        clock.now.return_value = datetime(2025, 5, 1, 2, 59)
+        app.plan_charging({})
+        assert app.check_skip_charge.call_count == 2
+    finally:
+        patch.stopall()
+
+def test_always_charge_is_checked_for_every_new_interval(app):
+    # 08:00 is not cheap enough to always charge at 06:44, but it is once the run at 07:59 reaches it
+    prices = [1.0] * 24
+    prices[8:10] = [0.05, -0.2]
+    states = {"sensor.tibber": tibber_state(prices), "sensor.battery_soc": {"state": "20", "attributes": {}}}
+    app.get_state.side_effect = lambda entity, attribute=None, **kwargs: {
+        k: v for k, v in states.items() if k.startswith(entity + ".")
+    }
+    app.args["tibber_sensor"] = "sensor.tibber"
+    app.args["always_charge_factor"] = 0.1
+
+    with patch("smart_battery.datetime") as mock_datetime:
+        mock_datetime.now.return_value = datetime(2025, 5, 1, 6, 44)
+        app.plan_charging({})
+        assert app._stats.decision == "not_candidate"
+        mock_datetime.now.return_value = datetime(2025, 5, 1, 7, 59)
+        app.plan_charging({})
+    assert app._stats.decision == "always_charge"
+    assert app.run_at.call_args.args[:2] == (app.start_charging, datetime(2025, 5, 1, 8, 0))
+
+def test_small_soc_changes_keep_the_plan(app):
+    clock = session_app(app, datetime(2025, 5, 1, 1, 44))
+    try:
+        del app.get_current_soc
+        app.get_candidate_hours = MagicMock(return_value=[datetime(2025, 5, 1, 2, 0)])
+        mock_states(app, {"sensor.battery_soc": "50"})
+        app.plan_charging({})
+
+        # Charging or a drop of up to replan_soc_drop percent keeps the plan
+        for soc in ("60", "46"):
+            app.on_input_change("sensor.battery_soc", "state", "50", soc, {})
+            mock_states(app, {"sensor.battery_soc": soc})
+            app.plan_charging({})
+            assert app._stats.decision == "unchanged"
+        app.run_in.assert_not_called()
+
+        # A larger drop plans again
+        app.on_input_change("sensor.battery_soc", "state", "46", "44", {})
+        app.run_in.assert_called_once()
+        mock_states(app, {"sensor.battery_soc": "44"})
+        clock.now.return_value = datetime(2025, 5, 1, 1, 45)
+        app.plan_charging({})
+        assert app.check_skip_charge.call_count == 2
+        assert app._plan_soc == pytest.approx(0.44)
+    finally:
+        patch.stopall()
+
+def test_schedule_charge_deduplicates_timers(app):
+    target_time = (datetime.now() + timedelta(minutes=10)).replace(second=0, microsecond=0)
+    app.run_at.return_value = "timer-1"
+    app.schedule_charge(target_time)
+    app.schedule_charge(target_time)
+
+    app.run_at.assert_called_once()
+    assert app.get_charge_timers() == {target_time: "timer-1"}
+
+def test_update_charge_timers_cancels_dropped_slots(app):
+    slot_1 = (datetime.now() + timedelta(minutes=10)).replace(second=0, microsecond=0)
+    slot_2 = slot_1 + timedelta(minutes=15)
+    app.run_at.side_effect = ["timer-1", "timer-2"]
+    app.update_charge_timers([slot_1])
+    app.update_charge_timers([slot_2])
+
+    app.cancel_timer.assert_called_once_with("timer-1", silent=True)
+    assert app.get_charge_timers() == {slot_2: "timer-2"}
+
+def test_start_charging_clears_timer(app):
+    slot = (datetime.now() + timedelta(minutes=10)).replace(second=0, microsecond=0)
+    app.run_at.return_value = "timer-1"
+    app.schedule_charge(slot)
+    app.start_charging(app.run_at.call_args.kwargs)
+
+    assert app.get_charge_timers() == {}
+    app.call_service.assert_called_once()
+
+def session_app(app, now):
+    app.run_at.side_effect = lambda callback, start, **kwargs: f"timer-{start:%H%M}"
+    app.get_current_soc = MagicMock(return_value=0.5)
+    app.check_always_charge = MagicMock(return_value=False)
+    app.check_skip_charge = MagicMock(return_value=False)
+    mock_datetime = patch("smart_battery.datetime").start()
+    mock_datetime.now.return_value = now
+    return mock_datetime
+
+def test_adjacent_candidate_hours_merge_into_one_session(app):
+    clock = session_app(app, datetime(2025, 5, 1, 1, 59))
+    try:
+        app.get_candidate_hours = MagicMock(return_value=[datetime(2025, 5, 1, h, 0) for h in (2, 3, 4)])
+        app.plan_charging({})
+        app.run_at.assert_called_once()
+        assert app.run_at.call_args.kwargs["duration"] == 180
+
+        # The next tick falls inside the running session and leaves it alone
+        app.start_charging(app.run_at.call_args.kwargs)
+        mock_states(app, {"sensor.battery_soc": "51"})
+        clock.now.return_value = datetime(2025, 5, 1, 2, 14)
+        app.plan_charging({})
+        app.run_at.assert_called_once()
+        app.call_service.assert_called_once()
+    finally:
+        patch.stopall()
+
+def test_running_session_is_shortened_and_stopped(app):
+    clock = session_app(app, datetime(2025, 5, 1, 1, 59))
+    try:
+        app.args["charge_stop_script"] = "script.stop_battery_charge"
+        app.get_candidate_hours = MagicMock(return_value=[datetime(2025, 5, 1, h, 0) for h in (2, 3, 4)])
+        app.plan_charging({})
+        app.start_charging(app.run_at.call_args.kwargs)
+
+        # Prices changed, the session now ends at 03:00
+        app.get_candidate_hours.return_value = [datetime(2025, 5, 1, 2, 0)]
+        mock_states(app, {"sensor.solar_next_hour_1": "0.1"})
+        clock.now.return_value = datetime(2025, 5, 1, 2, 14)
+        app.plan_charging({})
+        assert app.run_at.call_args.args[:2] == (app.stop_charging, datetime(2025, 5, 1, 3, 0))
+        assert app._charge_session == (datetime(2025, 5, 1, 2, 0), datetime(2025, 5, 1, 3, 0))
+
+        # Without a stop script the charge script is started again with the shorter duration
+        del app.args["charge_stop_script"]
+        app.get_candidate_hours.return_value = [datetime(2025, 5, 1, h, 0) for h in (2, 3)]
+        mock_states(app, {"sensor.solar_next_hour_1": "0.3"})
+        app.plan_charging({})
+        app.get_candidate_hours.return_value = [datetime(2025, 5, 1, 2, 0)]
+        mock_states(app, {"sensor.solar_next_hour_1": "0.1"})
+        app.plan_charging({})
+        assert app.run_at.call_args.args[:2] == (app.start_charging, datetime(2025, 5, 1, 2, 15))
+        assert app.run_at.call_args.kwargs["duration"] == 45
+        app.args["charge_stop_script"] = "script.stop_battery_charge"
+
+        # The battery no longer needs charging, the session is stopped at the next interval
+        app.check_skip_charge.return_value = True
+        mock_states(app, {"sensor.solar_next_hour_1": "0.2"})
+        clock.now.return_value = datetime(2025, 5, 1, 2, 29)
+        app.plan_charging({})
+        assert app.run_at.call_args.args[:2] == (app.stop_charging, datetime(2025, 5, 1, 2, 30))
+        app.stop_charging(app.run_at.call_args.kwargs)
+        app.call_service.assert_called_with("script/turn_on", entity_id="script.stop_battery_charge")
+    finally:
+        patch.stopall()
+
+def test_cancelled_pending_session_is_scheduled_again(app):
+    clock = session_app(app, datetime(2025, 5, 1, 1, 59))
+    try:
+        app.get_candidate_hours = MagicMock(return_value=[datetime(2025, 5, 1, h, 0) for h in (2, 3, 4)])
+        app.plan_charging({})
+
+        # An input change before the session starts skips charging and cancels its timer
+        app.check_skip_charge.return_value = True
+        mock_states(app, {"sensor.solar_next_hour_1": "2.0"})
+        clock.now.return_value = datetime(2025, 5, 1, 1, 59, 30)
+        app.plan_charging({})
+        app.cancel_timer.assert_called_once_with("timer-0200", silent=True)
+        assert app._charge_session is None
+
+        # The next tick charges again for the rest of the cheap window
+        app.check_skip_charge.return_value = False
+        mock_states(app, {"sensor.solar_next_hour_1": "0.5"})
+        clock.now.return_value = datetime(2025, 5, 1, 2, 14)
+        app.plan_charging({})
+        args, kwargs = app.run_at.call_args
+        assert args == (app.start_charging, datetime(2025, 5, 1, 2, 15))
+        assert kwargs["duration"] == 165
+        assert app._charge_session == (datetime(2025, 5, 1, 2, 15), datetime(2025, 5, 1, 5, 0))
+    finally:
+        patch.stopall()
+
+
+def test_project_soc_charges_candidates_until_target():
+    candidates = np.array([True, True, True, False, True])
+    targets = np.full(5, 0.5)
+    solar = np.array([0.0, 0.0, 0.0, 1.0, 0.0])
+    charge, projected = project_soc(candidates, targets, solar, 0.2, 10, 2.0)
+    assert charge.tolist() == [True, True, False, False, False]
+    assert projected == pytest.approx([0.4, 0.6, 0.6, 0.7, 0.7])
+
+def test_horizon_plan_published_and_evicts_past_slots(app):
+    prices = [1.0, 0.9, 0.3, 0.2, 0.3, 0.9, 1.1, 1.3] * 3 + [1.0] * 24
+    mock_tibber(app, tibber_state(prices))
+    app.get_current_soc = MagicMock(return_value=0.2)
+    app.get_solar_next_hour = MagicMock(return_value=0.0)
+
+    with patch("smart_battery.datetime") as mock_datetime:
+        mock_datetime.now.return_value = datetime(2025, 5, 1, 1, 59)
+        plan = app.update_horizon_plan(datetime(2025, 5, 1, 2, 0))
+        assert plan.times[0] == datetime(2025, 5, 1, 1, 0)
+        assert len(plan) == 47
+
+        args, kwargs = app.set_state.call_args
+        assert args == ("sensor.smart_battery_plan",)
+        assert kwargs["state"] == datetime(2025, 5, 1, 2, 0).isoformat()
+        attributes = kwargs["attributes"]
+        assert attributes["start"] == "2025-05-01T01:00:00"
+        assert attributes["interval_minutes"] == 60
+        assert attributes["prices"][:3] == [0.9, 0.3, 0.2]
+        assert attributes["projected_soc"][1] == 0.5
+        assert attributes["solar_kwh"][1] == 0.0
+        # The target is reached after one slot, later candidates are not charged
+        assert attributes["candidate_windows"][0] == ["2025-05-01T02:00:00", "2025-05-01T05:00:00"]
+        assert attributes["charge_windows"] == [["2025-05-01T02:00:00", "2025-05-01T03:00:00"]]
+        assert attributes["charge_slots"] == 1
+
+        # Slots that have ended are evicted, an unchanged plan is not published again
+        mock_datetime.now.return_value = datetime(2025, 5, 1, 3, 10)
+        plan = app.update_horizon_plan(datetime(2025, 5, 1, 3, 15))
+        assert plan.times[0] == datetime(2025, 5, 1, 3, 0)
+        assert len(plan) == 45
+        set_state_calls = app.set_state.call_count
+        app.update_horizon_plan(datetime(2025, 5, 1, 3, 15))
+        assert app.set_state.call_count == set_state_calls
+
+def test_horizon_plan_attributes_stay_compact(app):
+    # Two days of quarter hour prices
+    rng = np.random.default_rng(1)
+    start = datetime(2025, 5, 1, 0, 0)
+    entries = [
+        {"startsAt": (start + timedelta(minutes=15 * i)).isoformat() + "+02:00", "total": float(rng.uniform(0.1, 2.0))}
+        for i in range(192)
+    ]
+    mock_tibber(app, {
+        "state": "1.0",
+        "last_updated": "2025-05-01T13:00:00+00:00",
+        "attributes": {"today": entries[:96], "tomorrow": entries[96:]},
+    })
+    app.get_current_soc = MagicMock(return_value=0.2)
+    app.get_solar_next_hour = MagicMock(return_value=0.0)
+
+    with patch("smart_battery.datetime") as mock_datetime:
+        mock_datetime.now.return_value = datetime(2025, 5, 1, 0, 1)
+        plan = app.update_horizon_plan(datetime(2025, 5, 1, 0, 15))
+    assert len(plan) == 192
+    attributes = app.set_state.call_args.kwargs["attributes"]
+    assert len(json.dumps(attributes)) < 8000
+
+    # The plan is restored from its attributes
+    restored = HorizonPlan.from_attributes(plan.key, app.get_price_snapshot(), attributes)
+    assert restored.times == plan.times
+    assert restored.candidates.tolist() == plan.candidates.tolist()
+    assert restored.charge.tolist() == plan.charge.tolist()
+
+def test_unchanged_ticks_only_evict_the_plan(app):
+    prices = [1.0, 0.9, 0.3, 0.2, 0.3, 0.9, 1.1, 1.3] * 3 + [1.0] * 24
+    mock_cached_tibber(app, tibber_state(prices))
+    app.get_current_soc = MagicMock(return_value=0.2)
+    app.check_skip_charge = MagicMock(return_value=False)
+
+    with patch("smart_battery.datetime") as mock_datetime:
+        mock_datetime.now.return_value = datetime(2025, 5, 1, 1, 44)
+        app.plan_charging({})
+        assert len(app._horizon_plan) == 47
+        app.build_horizon_plan = MagicMock()
+
+        mock_datetime.now.return_value = datetime(2025, 5, 1, 2, 14)
+        app.plan_charging({})
+        assert app._stats.decision == "unchanged"
+        app.build_horizon_plan.assert_not_called()
+        assert app._horizon_plan.times[0] == datetime(2025, 5, 1, 2, 0)
+        assert app.set_state.call_args_list[-2].kwargs["attributes"]["start"] == "2025-05-01T02:00:00"
+
+def test_plan_is_only_formatted_when_published(app):
+    prices = [1.0, 0.9, 0.3, 0.2, 0.3, 0.9, 1.1, 1.3] * 3 + [1.0] * 24
+    mock_cached_tibber(app, tibber_state(prices))
+    app.get_current_soc = MagicMock(return_value=0.2)
+    app.check_skip_charge = MagicMock(return_value=False)
+
+    with patch("smart_battery.datetime") as mock_datetime, patch.object(HorizonPlan, "attributes", autospec=True,
+                                                                        side_effect=HorizonPlan.attributes) as attributes:
+        mock_datetime.now.return_value = datetime(2025, 5, 1, 1, 44)
+        app.plan_charging({})
+        assert attributes.call_count == 1
+
+        # A rebuilt plan with the same values is not formatted again
+        app._plan_key = None
+        app.plan_charging({})
+        assert app._stats.decision != "unchanged"
+        assert attributes.call_count == 1
+
+        # Without a plan sensor the plan is not built at all
+        app.args["plan_sensor"] = ""
+        app._plan_key = None
+        app.build_horizon_plan = MagicMock()
+        app.plan_charging({})
+        app.build_horizon_plan.assert_not_called()
+
+def test_plan_charging_publishes_planner_sensor(app, tmp_path):
+    metrics_file = tmp_path / "smart_battery.prom"
+    app.args["metrics_file"] = str(metrics_file)
+    mock_states(app, {"sensor.battery_soc": "60", "sensor.solar_next_hour_1": "1.0"})
+    app.check_always_charge = MagicMock(return_value=False)
+    app.check_skip_charge = MagicMock(return_value=True)
+
+    with patch("smart_battery.datetime") as mock_datetime:
+        mock_datetime.now.return_value = datetime(2025, 5, 1, 1, 59)
+        app.plan_charging({})
+
+    args, kwargs = app.set_state.call_args
+    assert args == ("sensor.smart_battery_planner",)
+    assert kwargs["state"] == "skip"
+    for stage in ("inputs", "soc", "always_charge", "target", "skip_check", "schedule"):
+        assert kwargs["attributes"][f"{stage}_ms"] >= 0
+    assert "candidates_ms" not in kwargs["attributes"]
+
+    metrics = metrics_file.read_text()
+    assert 'smart_battery_planning_stage_seconds{stage="skip_check"}' in metrics
+    assert 'smart_battery_planning_runs_total{decision="skip"} 1' in metrics
+
+def test_planning_stats_counts_cache_hits(app):
+    mock_tibber(app, tibber_state([1.0, 0.5, 2.0]))
+    app.get_candidate_hours()
+    app.get_candidate_hours()
+    assert app._stats.counters == {"price_cache_miss": 1, "price_cache_hit": 1, "candidate_cache_hit": 1, "smoothed_slots": 3}
+
+def test_state_snapshot_is_read_once_per_cycle(app):
+    mock_states(app, {
+        "sensor.battery_soc": "30",
+        "sensor.solar_next_hour_1": "0.5",
+        "sensor.solar_next_hour_2": "0.25",
+        "sensor.solar_remaining_1": "1.0",
+        "sensor.other": "ignored",
+    })
+    app.check_always_charge = MagicMock(return_value=False)
+    app.get_candidate_hours = MagicMock(return_value=[])
+
+    with patch("smart_battery.datetime") as mock_datetime:
+        mock_datetime.now.return_value = datetime(2025, 5, 1, 1, 59)
+        mock_datetime.strptime = datetime.strptime
+        app.plan_charging({})
+
+    app.get_state.assert_called_once_with("sensor", copy=False)
+    app.log.assert_any_call("Expected solar production next hour: 0.75 kWh")
+    assert app._state is None
+
+def test_state_snapshot_is_read_only():
+    snapshot = StateSnapshot({"sensor.x": {"state": "1", "attributes": {"a": 2}, "last_updated": "t"}})
+    assert snapshot.get("sensor.x") == "1"
+    assert snapshot.get("sensor.x", "a") == 2
+    assert snapshot.get("sensor.x", "last_updated") == "t"
+    assert snapshot.get("sensor.y") is None
+    with pytest.raises(TypeError):
+        snapshot.get("sensor.x", "all")["state"] = "2"
+    with pytest.raises(TypeError):
+        snapshot.get("sensor.x", "all")["attributes"]["a"] = 3
+
+def test_solar_forecast_aligned_to_price_slots():
+    # 1 kW for an hour, then 2 kWh in the next hour and nothing after that
+    watts = solar_forecast_periods({"watts": {"2025-05-01T10:00:00+02:00": 1000, "2025-05-01T11:00:00+02:00": 2000}})
+    wh = solar_forecast_periods({"wh_period": {"2025-05-01T10:00:00+02:00": 1000, "2025-05-01T11:00:00+02:00": 2000}})
+    assert wh[2].tolist() == watts[2].tolist() == [1.0, 2.0]
+
+    # Periods are kept in UTC
+    start = datetime(2025, 5, 1, 8, 0)
+    bounds = np.array([(start + timedelta(minutes=15 * i) - datetime(1970, 1, 1)).total_seconds() for i in range(13)])
+    energy = align_energy(*watts, bounds[:-1], bounds[1:])
+    assert energy == pytest.approx([0.25] * 4 + [0.5] * 4 + [0.0] * 4)
+    assert solar_forecast_periods({"watts": {}}) is None
+
+def mock_solar_forecast(app, prices, profile, last_updated="2025-05-01T05:00:00+00:00"):
+    app.args["tibber_sensor"] = "sensor.tibber"
+    app.args["solar_arrays"] = [{"forecast": "sensor.forecast_1"}, {"forecast": "sensor.forecast_2"}]
+    forecast = {
+        "state": "0",
+        "last_updated": last_updated,
+        "attributes": {"wh_period": {f"2025-05-01T{h:02d}:00:00+02:00": wh for h, wh in profile.items()}},
+    }
+    entities = {"sensor.tibber": tibber_state(prices), "sensor.forecast_1": forecast, "sensor.forecast_2": forecast}
+
+    def get_state(entity, attribute=None, **kwargs):
+        state = entities[entity]
+        if attribute == "all":
+            return state
+        return state.get(attribute) if attribute else state["state"]
+
+    app.get_state.side_effect = get_state
+    return forecast
+
+def test_solar_forecast_replaces_scalar_sensors(app):
+    forecast = mock_solar_forecast(app, [1.0] * 24, {10: 1000, 11: 2000, 12: 500})
+
+    with patch("smart_battery.datetime") as mock_datetime:
+        mock_datetime.now.return_value = datetime(2025, 5, 1, 10, 30)
+        assert app.get_solar_next_hour() == pytest.approx(3.0)
+        assert app.get_solar_remaining() == pytest.approx(6.0)
+        assert app.get_solar_profile(11, datetime(2025, 5, 1, 10, 45)).tolist()[:2] == [4.0, 1.0]
+        assert app._stats.counters["solar_cache_miss"] == 1
+        assert app._stats.counters["solar_cache_hit"] == 2
+
+        forecast["last_updated"] = "2025-05-01T06:00:00+00:00"
+        forecast["attributes"] = {"wh_period": {"2025-05-01T11:00:00+02:00": 500}}
+        assert app.get_solar_remaining() == pytest.approx(1.0)
+        assert app._stats.counters["solar_cache_miss"] == 2
+
+def test_solar_profile_keeps_both_slots_of_the_repeated_hour(app):
+    # Clocks go back at 03:00 on 2025-10-26, the two 02:00 hours have a different forecast
+    entries = [{"startsAt": t, "total": 1.0} for t in (
+        "2025-10-26T01:00:00+02:00", "2025-10-26T02:00:00+02:00", "2025-10-26T02:00:00+01:00", "2025-10-26T03:00:00+01:00",
+    )]
+    forecast = {"state": "0", "last_updated": "2025-10-26T00:00:00+00:00", "attributes": {"wh_period": {
+        "2025-10-26T02:00:00+02:00": 1000, "2025-10-26T02:00:00+01:00": 3000,
+    }}}
+    entities = {"sensor.tibber": {"state": "1.0", "last_updated": "key", "attributes": {"today": entries}}, "sensor.forecast": forecast}
+    app.get_state.side_effect = lambda entity, attribute=None, **kwargs: (
+        entities[entity] if attribute == "all" else entities[entity].get(attribute) if attribute else entities[entity]["state"]
+    )
+    app.args["tibber_sensor"] = "sensor.tibber"
+    app.args["solar_arrays"] = [{"forecast": "sensor.forecast"}]
+    assert app.get_solar_profile(0, datetime(2025, 10, 26, 0, 45)).tolist() == [0.0, 1.0, 3.0, 0.0]
+    assert app.get_solar_profile(2, datetime(2025, 10, 26, 0, 45)).tolist() == [3.0, 0.0]
+
+def test_skip_charge_when_solar_covers_targets(app):
+    app.args["soc_targets"] = [0.5] * 12 + [0.8] * 12
+    mock_solar_forecast(app, [1.0] * 24, {10: 1000, 11: 1000})
+
+    with patch("smart_battery.datetime") as mock_datetime:
+        mock_datetime.now.return_value = datetime(2025, 5, 1, 10, 0)
+        mock_datetime.strptime = datetime.strptime
+        # 2 kWh per hour from both arrays before the target rises to 80% at noon
+        assert app.check_skip_charge(0.45, 0.5, 0.5)
+        app.log.assert_any_call("Skipping charge: Expected solar production keeps the battery above the SoC targets today")
+        # Starting lower, the battery misses the afternoon target
+        assert not app.solar_covers_targets(0.3)
+        # The remaining solar is more than double the energy needed, but the balance decides
+        assert not app.check_skip_charge(0.3, 0.5, 1.5)
+
+def test_solar_balance_is_capped_at_capacity(app):
+    app.args["soc_targets"] = [0.3] * 24
+    mock_solar_forecast(app, [1.0] * 24, {10: 5000})
+    profile = LoadProfile("unused.db", "sensor.house_energy")
+    profile.kwh[:] = 1.0
+    profile.update = MagicMock(return_value=0)
+    app._load_profile = profile
+    app.args["load_statistic"] = "sensor.house_energy"
+
+    with patch("smart_battery.datetime") as mock_datetime:
+        mock_datetime.now.return_value = datetime(2025, 5, 1, 10, 0)
+        # 10 kWh of morning solar only tops up a nearly full battery, the evening load then drains it
+        assert not app.solar_covers_targets(0.9)
+
+def test_solar_arrays_from_list(app):
+    app.args["solar_arrays"] = [
+        {"energy_next_hour": f"sensor.next_{i}", "energy_today_remaining": f"sensor.remaining_{i}"} for i in range(3)
+    ]
+    mock_states(app, {f"sensor.next_{i}": str(i) for i in range(3)} | {f"sensor.remaining_{i}": "2" for i in range(3)})
+    assert app.get_solar_next_hour() == 3.0
+    assert app.get_solar_remaining() == 6.0
+    assert "sensor.remaining_2" in app.get_input_entities()
+    assert "sensor.solar_next_hour_1" not in app.get_input_entities()
+
+@pytest.mark.parametrize("now, soc", [
+    (datetime(2025, 5, 1, 1, 59), "40"),
+    (datetime(2025, 5, 1, 2, 44), "40"),
+    (datetime(2025, 5, 1, 5, 14), "95"),
+    (datetime(2025, 5, 1, 7, 59), "20"),
+    (datetime(2025, 5, 1, 23, 59), "100"),
+])
+def test_async_planning_makes_identical_decisions(now, soc):
+    prices = [1.0, 0.9, 0.3, 0.2, 0.3, 0.9, 1.1, 1.3] * 3 + [1.0] * 24
+    state = tibber_state(prices)
+    states = {
+        "sensor.battery_soc": {"state": soc, "attributes": {}},
+        "sensor.tibber": state,
+        "sensor.solar_next_hour_1": {"state": "0.2", "attributes": {}},
+        "sensor.solar_remaining_1": {"state": "1.0", "attributes": {}},
+    }
+
+    def get_state(entity, attribute=None, **kwargs):
+        return {k: v for k, v in states.items() if k.startswith(entity + ".")}
+
+    sync_app, async_app = make_app(), make_app()
+    for app in (sync_app, async_app):
+        app.args["tibber_sensor"] = "sensor.tibber"
+        app.args["always_charge_factor"] = 0.5
+    sync_app.get_state.side_effect = get_state
+    async_app.args["async_planning"] = True
+    async_app.get_state = AsyncMock(side_effect=get_state)
+    async_app.run_in_executor = AsyncMock(side_effect=lambda func, *args: func(*args))
+
+    with patch("smart_battery.datetime") as mock_datetime:
+        mock_datetime.now.return_value = now
+        mock_datetime.strptime = datetime.strptime
+        sync_app.plan_charging({})
+        asyncio.run(async_app.plan_charging_async({}))
+
+    assert async_app.get_planning_callback() == async_app.plan_charging_async
+    assert async_app.get_state.await_count == 1
+    assert async_app.run_in_executor.await_count == 1
+    assert async_app._stats.decision == sync_app._stats.decision
+    scheduled = lambda app: [(c.args[1:], c.kwargs) for c in app.run_at.call_args_list]
+    assert scheduled(async_app) == scheduled(sync_app)
+
+def test_planning_runs_are_serialized(app):
+    # A tick and a replan handed to different executor threads at the same time
+    snapshots = [StateSnapshot({"sensor.battery_soc": {"state": soc}}) for soc in ("50", "60")]
+    active, seen = [], []
+
+    def should_charge(next_interval):
+        active.append(app._state)
+        seen.append(len(active))
+        time.sleep(0.05)
+        seen.append(app._state is active[-1])
+        active.pop()
+        return []
+
+    app.should_charge = MagicMock(side_effect=should_charge)
+    threads = [threading.Thread(target=app.plan_charging, args=({}, snapshot)) for snapshot in snapshots]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert seen == [1, True, 1, True]
+    assert app._state is None
+
+def test_fleet_shares_prices_and_staggers_charging(app):
+    prices = [1.0, 0.9, 0.3, 0.2, 0.3, 0.9, 1.1, 1.3] * 3 + [1.0] * 24
+    states = {
+        "sensor.tibber": tibber_state(prices),
+        "sensor.house_soc": {"state": "20", "attributes": {}},
+        "sensor.cabin_soc": {"state": "30", "attributes": {}},
+    }
+    app.get_state.side_effect = lambda entity, attribute=None, **kwargs: {
+        k: v for k, v in states.items() if k.startswith(entity + ".")
+    }
+    app.args["tibber_sensor"] = "sensor.tibber"
+    app.args["always_charge_factor"] = 0.1
+    app.args["charge_stagger_seconds"] = 20
+    app.args["batteries"] = [
+        {"name": "house", "soc_sensor": "sensor.house_soc", "charge_script": "script.house_charge"},
+        {"name": "cabin", "soc_sensor": "sensor.cabin_soc", "battery_capacity_kwh": 5},
+    ]
+    app.init_fleet()
+    house, cabin = app._members
+    assert "sensor.cabin_soc" in app.get_input_entities()
+
+    with patch("smart_battery.datetime") as mock_datetime, \
+            patch("smart_battery.PriceSnapshot", wraps=PriceSnapshot) as snapshot_cls:
+        mock_datetime.now.return_value = datetime(2025, 5, 1, 1, 59)
+        mock_datetime.strptime = datetime.strptime
+        app.plan_charging({})
+
+    assert snapshot_cls.call_count == 1
+    app.get_state.assert_called_once_with("sensor", copy=False)
+    assert app._stats.decision == "fleet"
+    assert house._stats.decision == cabin._stats.decision == "charge"
+
+    # Each battery gets its own timer, the second one offset by the stagger
+    timers = {c.args[0].__self__.name: c for c in app.run_at.call_args_list}
+    assert timers["house"].args[1] == datetime(2025, 5, 1, 2, 0)
+    assert timers["cabin"].args[1] == datetime(2025, 5, 1, 2, 0, 20)
+
+    house.start_charging(timers["house"].kwargs)
+    assert not house.get_charge_timers()
+    assert app.call_service.call_args.kwargs["entity_id"] == "script.house_charge"
+    assert app.set_state.call_args.args == ("sensor.smart_battery_planner",)
+    assert {c.args[0] for c in app.set_state.call_args_list} >= {
+        "sensor.smart_battery_planner_house", "sensor.smart_battery_planner_cabin",
+    }
+
+def test_fleet_battery_uses_quarter_hour_slots(app):
+    # Quarter hour prices with a cheap half hour from 02:15
+    start = datetime(2025, 5, 1, 0, 0)
+    cheap = {9: 0.3, 10: 0.2, 11: 0.3}
+    entries = [
+        {"startsAt": (start + timedelta(minutes=15 * i)).isoformat() + "+02:00", "total": cheap.get(i, 1.0)}
+        for i in range(96)
+    ]
+    states = {
+        "sensor.tibber": {"state": "1.0", "last_updated": "2025-05-01T00:00:00+00:00", "attributes": {"today": entries}},
+        "sensor.battery_soc": {"state": "20", "attributes": {}},
+    }
+    app.get_state.side_effect = lambda entity, attribute=None, **kwargs: {
+        k: v for k, v in states.items() if k.startswith(entity + ".")
+    }
+    app.args["tibber_sensor"] = "sensor.tibber"
+    app.args["always_charge_factor"] = 0.1
+    app.args["smoothing_window_minutes"] = 15
+    single = make_app()
+    single.args = dict(app.args)
+    single.get_state.side_effect = app.get_state.side_effect
+    app.args["batteries"] = [{"name": "house"}]
+    app.init_fleet()
+    house, = app._members
+
+    with patch("smart_battery.datetime") as mock_datetime:
+        mock_datetime.now.return_value = datetime(2025, 5, 1, 2, 14)
+        mock_datetime.strptime = datetime.strptime
+        single.plan_charging({})
+        app.plan_charging({})
+
+    assert house.get_slot_start(datetime(2025, 5, 1, 2, 20)) == datetime(2025, 5, 1, 2, 15)
+    assert single._stats.decision == house._stats.decision == "charge"
+    assert app.run_at.call_args.kwargs["duration"] == single.run_at.call_args.kwargs["duration"] == 45
+
+def mock_cached_tibber(app, state):
+    # Bulk domain reads for planning runs and single entity reads at startup
+    app.args["tibber_sensor"] = "sensor.tibber"
+
+    def get_state(entity, attribute=None, **kwargs):
+        if entity == "sensor":
+            return {"sensor.tibber": state}
+        return state.get(attribute) if attribute else None
+
+    app.get_state.side_effect = get_state
+
+def test_cache_restores_prices_and_charge_timers(tmp_path):
+    prices = [1.0, 0.9, 0.3, 0.2, 0.3, 0.9, 1.1, 1.3] * 3
+    state = tibber_state(prices)
+    cache_file = tmp_path / "cache.json"
+    first = make_app()
+    mock_cached_tibber(first, state)
+    first.args["always_charge_factor"] = 0.1
+    first._cache_file = str(cache_file)
+    first.get_current_soc = MagicMock(return_value=0.2)
+    first.check_skip_charge = MagicMock(return_value=False)
+
+    with patch("smart_battery.datetime") as mock_datetime:
+        mock_datetime.now.return_value = datetime(2025, 5, 1, 1, 59)
+        first.plan_charging({})
+    assert first.run_at.call_args.kwargs["duration"] == 180
+
+    # Restarted before the session starts: prices are not parsed again and the timer is re-armed
+    second = make_app()
+    mock_cached_tibber(second, state)
+    second._cache_file = str(cache_file)
+    with patch("smart_battery.datetime") as mock_datetime, \
+            patch("smart_battery.parse_price_entries") as parse:
+        mock_datetime.now.return_value = datetime(2025, 5, 1, 1, 59, 30)
+        second.load_cache()
+        assert second.get_price_snapshot().prices.tolist() == prices
+    parse.assert_not_called()
+    assert second._charge_session == (datetime(2025, 5, 1, 2, 0), datetime(2025, 5, 1, 5, 0))
+    args, kwargs = second.run_at.call_args
+    assert args == (second.start_charging, datetime(2025, 5, 1, 2, 0))
+    assert kwargs["duration"] == 180
+    assert second._horizon_plan.times[0] == datetime(2025, 5, 1, 1, 0)
+
+    # Restarted after the session should have started: charge now for the rest of it
+    third = make_app()
+    mock_cached_tibber(third, state)
+    third._cache_file = str(cache_file)
+    with patch("smart_battery.datetime") as mock_datetime:
+        mock_datetime.now.return_value = datetime(2025, 5, 1, 2, 20)
+        third.load_cache()
+    third.run_at.assert_not_called()
+    assert third.run_in.call_args.kwargs["duration"] == 160
+
+    # A cache from before the last price update is ignored
+    state["last_updated"] = "2025-05-01T14:00:00+00:00"
+    fourth = make_app()
+    mock_cached_tibber(fourth, state)
+    fourth._cache_file = str(cache_file)
+    fourth.load_cache()
+    assert fourth._charge_session is None
+    fourth.log.assert_called_with("Planner cache is out of date, waiting for the first planning run")